@@ -3,13 +3,25 @@ from sklearn.feature_extraction.text import TfidfVectorizer
 from pathlib import Path
 from tqdm import tqdm
 import csv
-from datetime import datetime, date, timedelta
-import calendar
+from datetime import datetime, date
 from collections import Counter
 # import string
 import click
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 from NERPipeline import NERPipeline
+from wedss_reader import collect_text_fragments
+from wedss_index import WedssIncidentIndex
+from patient_cache import PatientColumnCache
+from date_periods import DatePeriod
+from incremental_store import IncrementalNERStore
+from outbreak_ner_cache import OutbreakNERCache
+from outbreak_parser import outbreak_match_keys, compare_outbreak_keys
+from text_rules import TextCleaner, DEFAULT_RULES_FILE
+from stream_pipeline import StageMonitor, run_stages
+from distributed_ner import ner_over_texts_distributed
+import copy
 import re
 from fuzzywuzzy import fuzz
 from fuzzywuzzy import process
@@ -26,9 +38,6 @@ logging.basicConfig(format='%(levelname)s :: %(filename)s :: %(funcName)s :: %(a
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-# TODO: batched NER processing
-# TODO: distributed processing
-
 class NotAValidFileNameError(Exception):
     pass
 
@@ -55,6 +64,36 @@ class ApolloDetector():
     ner_results: {incidentID:[[all ners], [all ner types], [all ner scores]]}
     outbreaks: dictionary of outbreak dictionaries by incidentID 
     {incidentID:{'outbreakID ':###, 'OutbreakLocation':###, etc)
+    cache_dir: optional directory for on-disk caches built from the WEDSS
+    extracts, and of the entities found in outbreak names
+    ingest_workers: number of processes used to read WEDSS files, default 1
+    dedup_segments: if True repeated text segments within an incident are run
+    through NER once, see NERPipeline
+    ner_batch_size: number of text chunks, across incidents, run through
+    the NER model per forward pass
+    ner_stride: number of tokens consecutive NER windows overlap by
+    ner_cache: optional SQLite file caching NER model predictions per window
+    across runs, bounded to ner_cache_max_mb
+    ner_backend: NER inference backend: torch, torch_int8 or onnx
+    ner_workers: number of forked processes running NER, default 1
+    distributed_dir: optional directory shared with distributed_ner workers on
+    any hosts, NER runs over work units of incidents written to it and the
+    results are merged, see distributed_ner
+    distributed_units: number of work units NER runs are sharded into
+    ner_gate: if True windows of text that can't hold entities by a rule based
+    check are not run through the NER model, and every ner_gate_check_every
+    skipped window is checked with the model, see NERPipeline
+    streaming: if True WEDSS text is read, cleaned, run through NER and
+    collected as a stream of incident blocks, each stage in its own thread,
+    see stream_text_to_entities
+    stream_queue_size: most incident blocks waiting in front of a streaming stage
+    outbreak_names: how outbreak names are turned into the names incident
+    entities are matched against: 'bert' runs them through NER, 'rules'
+    parses them with outbreak_parser, 'compare' uses NER and reports its
+    agreement with the parser
+    text_cleaner: TextCleaner applying the text cleaning rules before NER
+    incremental_store: optional IncrementalNERStore of NER results from
+    previous runs, only new or changed incidents are run through NER
     outbreak_stats: dictionary of statistics about outbreak matching 
         total_known_outbreaks_for_all_incident_ids: all outbreaks in WEDSS outbreak file for all incidentIDs in period, int
         unique_known_outbreaks_for_all_incident_ids: unique outbreaks in WEDSS outbreak file for all incidentIDs in period, list out outbreak# ids
@@ -73,7 +112,25 @@ class ApolloDetector():
                  output_path:str=None,
                  stop_entities_file:str=None,
                  file_prefix:str=None,
-                 final_report_only=True):
+                 final_report_only=True,
+                 cache_dir:str=None,
+                 ingest_workers:int=1,
+                 incremental_store:str=None,
+                 text_rules_file:str=None,
+                 dedup_segments:bool=False,
+                 ner_batch_size:int=8,
+                 ner_stride:int=64,
+                 ner_cache:str=None,
+                 ner_cache_max_mb:int=1024,
+                 ner_backend:str='torch',
+                 ner_workers:int=1,
+                 distributed_dir:str=None,
+                 distributed_units:int=64,
+                 ner_gate:bool=False,
+                 ner_gate_check_every:int=100,
+                 streaming:bool=False,
+                 stream_queue_size:int=4,
+                 outbreak_names:str='bert'):
 
         if not Path(data_folder).is_dir():
             raise NotADirectoryError(f'{self.data_folder.absolute()} is not a valid directory')
@@ -108,8 +165,37 @@ class ApolloDetector():
         if not file_prefix:
             self.file_prefix = ''
         
-        self.nlp = NERPipeline()
+        self.ner_workers = ner_workers
+        self.distributed_dir = Path(distributed_dir) if distributed_dir else None
+        self.distributed_units = distributed_units
+        self.nlp = NERPipeline(dedup_segments=dedup_segments, batch_size=ner_batch_size, stride=ner_stride,
+                               cache_path=ner_cache, cache_max_mb=ner_cache_max_mb, backend=ner_backend,
+                               gate=ner_gate, gate_check_every=ner_gate_check_every)
         self.final_report_only = final_report_only
+        self.streaming = streaming
+        self.stream_queue_size = stream_queue_size
+        if outbreak_names not in ('bert', 'rules', 'compare'):
+            raise ValueError(f"outbreak_names must be 'bert', 'rules' or 'compare', not {outbreak_names!r}")
+        self.outbreak_names = outbreak_names
+        
+        # text cleaning rules, supporting_data/text_cleaning_rules.csv unless a rules file is given
+        text_rules_file = Path(text_rules_file) if text_rules_file else DEFAULT_RULES_FILE
+        if not text_rules_file.exists():
+            raise FileNotFoundError(f'{text_rules_file.absolute()} does not exist')
+        self.text_cleaner = TextCleaner.from_file(text_rules_file)
+        
+        # opt-in on-disk cache of extract derived data, e.g. patient file columns
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.patient_cache = None
+        self.incident_index = None
+        self.outbreak_ner_cache = None
+        # number of processes reading WEDSS files in parallel
+        self.ingest_workers = ingest_workers
+        # opt-in store of NER results reused across runs for unchanged incidents
+        self.incremental_store = None
+        if incremental_store:
+            self.incremental_store = IncrementalNERStore(incremental_store,
+                                                         signature=f'{self.nlp.signature()}:{self.text_cleaner.signature()}')
 
         
     @staticmethod
@@ -269,27 +355,41 @@ class ApolloDetector():
         logger.info('extracting specific patient rows...')
         patient_rows = {}
         header_columns = []
-        with self.file_paths['patient'].open('r', encoding='ISO-8859-1') as f: 
-                f.seek(0)
-                lines=f.readlines()
-                for count, line in tqdm(enumerate(lines)):
-                    header_row = False
+        if self.cache_dir:
+            # read just the target rows using the incident index
+            incident_index = self.get_incident_index()
+            patient_file = self.file_paths['patient']
+            header_columns = incident_index.header(patient_file).split("|")
+            for line in incident_index.read_lines(patient_file, target_ids):
+                ls=line.split("|")
+                patient_rows[ls[0]] = ls
+        else:
+            with self.file_paths['patient'].open('r', encoding='ISO-8859-1') as f: 
+                for count, line in tqdm(enumerate(f)):
                     if count == 0:
-                        header_row = True
-                    ls=line.split("|")
-                    incidentID = ls[0]
-                    
-                    if header_row:
-                        header_columns = ls
-                    
-                    if (not header_row) and (incidentID in target_ids):
-                        patient_rows[incidentID] = ls
+                        header_columns = line.split("|")
+                        continue
+                    # check the leading IncidentID before splitting the whole row
+                    incidentID = line.partition("|")[0]
+                    if incidentID in target_ids:
+                        patient_rows[incidentID] = line.split("|")
         
         logger.info(f'found {len(patient_rows)}/{len(target_ids)}')
         self.dict_to_csv(patient_rows,
                          header_columns,
                          'specific_patient_rows')
     
+    @staticmethod
+    def _iter_data_rows(file:Path):
+        """
+        stream every row of a WEDSS file except the header row
+        :param file: WEDSS file Path
+        """
+        with file.open('r', encoding='ISO-8859-1') as f:
+            next(f, None)
+            for line in f:
+                yield line
+
     def extract_all_wedss_text_by_incident_id(self, target_ids:List):
         """
         :param target_ids: incidentIDs to get ALL data for
@@ -298,39 +398,30 @@ class ApolloDetector():
         logger.info('extracting all WEDSS data')
         
         raw_wedss_text={}
+        incident_index = self.get_incident_index() if self.cache_dir else None
        
         # iterate over all files in files list, 
         logger.info(f"reading in WEDSS files: {self.file_paths['all']}")
         for file in tqdm(self.file_paths['all']):
-            with file.open('r', encoding='ISO-8859-1') as f:
-                f.seek(0)
-                lines=f.readlines()
+            if incident_index:
+                # only the rows for target_ids, found with the incident index
+                rows = incident_index.read_lines(file, target_ids)
+            else:
+                rows = self._iter_data_rows(file)
+            
+            # for every row with an id in list of ids passed to fn
+            # append the file name and the whole row to that id's text
+            for line in rows:
+                incident_id = line.partition("|")[0]
+                if incident_id in target_ids:
+                    tmp='|'+file.stem+'|'+line
                 
-                # iterate over every line in a file
-                for counter, line in tqdm(enumerate(lines)):
-                    header_row = False
-                    if counter == 0:
-                        header_row=True
-                    ls=line.split("|")
-                    incident_id = ls[0]
-                                
-                    # for non-header/first file rows, if row has id in list of ids passed to fn
-                    # concatenate all values of all columns in that file that were in the NLPFields.csv file
-                    # concatenated into a string separated by '.'. 
-                    if not header_row:
-                        tmp=''
-                        if incident_id in target_ids:
-                            try:
-                                tmp=tmp+'|'+file.stem+'|'+line
-                            except:
-                                pass
-                        
-                            # if incidentID its not in self.raw_wedss_text dict already, 
-                            # append it and associated text, else just extend text.
-                            if incident_id not in raw_wedss_text:
-                                raw_wedss_text[incident_id]=tmp
-                            else:
-                                raw_wedss_text[incident_id]+=tmp 
+                    # if incidentID its not in self.raw_wedss_text dict already, 
+                    # append it and associated text, else just extend text.
+                    if incident_id not in raw_wedss_text:
+                        raw_wedss_text[incident_id]=tmp
+                    else:
+                        raw_wedss_text[incident_id]+=tmp 
                                 
         self.dict_to_csv(raw_wedss_text, 
                          columns=["IncidentID","Text"], 
@@ -346,54 +437,25 @@ class ApolloDetector():
                             'trailing_seven_days': the six days leading up to 'day' plus that day.
                             'month': all the days in the month of 'day'
                             'all': returns string 'all' rather than list of dates - date checker function 'date_in_range' knows what that means .
-        :return: self.date_range = List of datetimes
+        :return: self.date_range = List of datetimes, self.date_period = the
+        same period compiled to a DatePeriod interval
         """
         
         try:
-            d=day.split(" ")
-            d=d[0]
-            d=(datetime.strptime(d,'%Y-%m-%d'))
-            d=d.date()
-            if period == 'week':
-                day_of_week = d.isocalendar()[2]-1
-                start_date = d - timedelta(days=day_of_week)
-                self.date_range = [start_date + timedelta(days=i) for i in range(7)]
-            if period == 'trailing_seven_days':
-                start_date = d
-                self.date_range = [start_date - timedelta(days=i) for i in range(7)]                  
-            if period == 'month':
-                number_of_days = calendar.monthrange(d.year,d.month)[1]
-                self.date_range = [date(d.year, d.month, day) for day in range(1, number_of_days+1)]
-            if period == 'all':
-                self.date_range = 'all'                
-            if period not in ['week','month','all','trailing_seven_days']:
-                raise ValueError("period type must be 'week', 'month', trailing_seven_days' or 'all'")
+            self.date_period = DatePeriod(day, period)
+            self.date_range = self.date_period.dates
         except (IndexError, ValueError):
-            logger.error(f"Couldn't set date range with {type(d)}:{d} and {type(period)}:{period}")
+            logger.error(f"Couldn't set date range with {type(day)}:{day} and {type(period)}:{period}")
            
             
     def date_in_range(self, date:str) -> bool:
         """
-        helper function compare date to list of dates in range, return True if
-        in range, else False. If period is 'all', always return True.
+        helper function compare date to the range of dates in self.date_period,
+        return True if in range, else False. If period is 'all', always return True.
         :param date: plain text date in format "YYYY-MM-DD <stuff>"
         :return: True if date in range, else False. If can't convert date return False.
         """
-        if self.date_range == 'all':
-            return True
-        try:
-            d=date.split(" ")
-            d=d[0]
-            d=(datetime.strptime(d,'%Y-%m-%d'))
-            d=d.date()
-            if d in self.date_range:
-                return True
-            else:
-                return False
-                
-        except (IndexError,ValueError):
-            logger.warning(f"not a valid date value: {d}")
-            return False
+        return self.date_period.contains(date)
 
 
     def get_ids(self, target_date:str='', period:str='week', search_county:str='Dane',
@@ -417,54 +479,156 @@ class ApolloDetector():
             self.ids = id_dict
             
         if not ids:
-            with self.file_paths['patient'].open('r', encoding='ISO-8859-1') as f: 
-                f.seek(0)
-                lines=f.readlines()
-                logger.debug(f'target_date: {target_date}')
-                logger.debug(f'period: {period}')
-                # establish dates of interest
-                self.set_date_range(target_date, period)
-                logger.debug(f'searching from {self.date_range[0]} to {self.date_range[-1]}')
+            logger.debug(f'target_date: {target_date}')
+            logger.debug(f'period: {period}')
+            # establish dates of interest
+            self.set_date_range(target_date, period)
+            logger.debug(f'searching from {self.date_range[0]} to {self.date_range[-1]}')
+
+            matches, any_counter = self.select_ids_by_period([self.date_period], search_county)[0]
+            confirmed_counter = len(matches)
+            ids={}
+            for incidentID in matches:
+                ids[incidentID]=1
+            if scale_factor:
+                original_len = len(ids)
+                ids = {k:v for k,v in ids.items() if k in list(ids.keys())[::scale_factor]}
+                scaled_len = len(ids)
+                print(f'scaled ids from {original_len} to {scaled_len}')
+            print(f'total any status cases, in Dane county, in week of specified date:{any_counter}')            
+            print(f'total confirmed cases, in Dane county, in week of specified date:{confirmed_counter}')
+            self.ids=ids
+
+    def select_ids_by_period(self, date_periods:List[DatePeriod],
+                             search_county:str='Dane') -> List[Tuple[List, int]]:
+        """
+        find the incidents for any number of reporting periods in one pass
+        over the patient data, the patient file cache when self.cache_dir is
+        set, else the patient file itself.
+        :param date_periods: list of DatePeriods to select incidents for
+        :param search_county: county to search in for incidents
+        :return: per period (list of confirmed/probable incidentIDs in file
+        order, count of incidents in the period and county with any status)
+        """
+        usable_resolution_statues = ["Confirmed", "Probable"]
+        if self.cache_dir:
+            patient_cache = self.get_patient_cache()
+            return [patient_cache.select(patient_cache.date_mask(date_period),
+                                         search_county,
+                                         usable_resolution_statues)
+                    for date_period in date_periods]
+        return self.scan_patient_file(date_periods, search_county, usable_resolution_statues)
+
+    def scan_patient_file(self, date_periods:List[DatePeriod], search_county:str,
+                          usable_resolution_statues:List) -> List[Tuple[List, int]]:
+        """
+        read the patient file row by row and find incidents in each of date_periods
+        :param date_periods: list of DatePeriods to select incidents for
+        :param search_county: county to search in for incidents
+        :param usable_resolution_statues: ResolutionStatus values to keep
+        :return: per period (list of matching incidentIDs in file order, count
+        of incidents in the period and county with any resolution status)
+        """
+        matches = [[] for _ in date_periods]
+        any_counters = [0 for _ in date_periods]
+        in_periods = list(enumerate(date_period.contains for date_period in date_periods))
+        with self.file_paths['patient'].open('r', encoding='ISO-8859-1') as f: 
+            # for every line in patient file (not including header row), where:
+              # EpisodeDate not empty string and in specified week
+              # county=Dane
+              # resolutionStatus contains 'confirmed'
+            # add that to list of incident ids
+            for count, line in enumerate(f):
+                if count == 0:
+                    continue  # header row
+                # only split as far as the last column used
+                ls=line.split("|", 34)
+                incidentID = ls[0]
+                episode_date = ls[18]
+                county = ls[8]
+                resolution_status = ls[33]
                 
-                # for every line in patient file (not including header row), where:
-                  # EpisodeDate not empty string and in specified week
-                  # county=Dane
-                  # resolutionStatus contains 'confirmed'
-                # add that to list of incident ids
-                confirmed_counter = 0
-                any_counter = 0
-                ids={}
-                usable_resolution_statues = ["Confirmed", "Probable"]
-                for count, line in enumerate(lines):
-                    header_row = False
-                    if count == 0:
-                        header_row = True
-                    ls=line.split("|")
-                    incidentID = ls[0]
-                    episode_date = ls[18]
-                    county = ls[8]
-                    resolution_status = ls[33]
-                    
-                    if not header_row\
-                        and episode_date!=''\
-                        and self.date_in_range(episode_date)\
-                        and county==search_county:
-                            
-                        any_counter += 1
-                        
-                        if resolution_status.strip() in usable_resolution_statues:       
-                            ids[incidentID]=1
-                            confirmed_counter+=1
-                if scale_factor:
-                    original_len = len(ids)
-                    ids = {k:v for k,v in ids.items() if k in list(ids.keys())[::scale_factor]}
-                    scaled_len = len(ids)
-                    print(f'scaled ids from {original_len} to {scaled_len}')
-                print(f'total any status cases, in Dane county, in week of specified date:{any_counter}')            
-                print(f'total confirmed cases, in Dane county, in week of specified date:{confirmed_counter}')
-                self.ids=ids
+                if episode_date!='' and county==search_county:
+                    usable = resolution_status.strip() in usable_resolution_statues
+                    for i, in_period in in_periods:
+                        if in_period(episode_date):
+                            any_counters[i] += 1
+                            if usable:
+                                matches[i].append(incidentID)
+        return list(zip(matches, any_counters))
+
+    def get_incident_index(self) -> WedssIncidentIndex:
+        """
+        load the IncidentID byte offset index of all WEDSS files from
+        self.cache_dir, (re)building it if any WEDSS file has changed since it
+        was indexed.
+        :return: loaded WedssIncidentIndex
+        """
+        if self.incident_index is None or not self.incident_index.is_valid():
+            if self.incident_index:
+                self.incident_index.close()
+            self.incident_index = WedssIncidentIndex(self.file_paths['all'],
+                                                     self.cache_dir / 'wedss_incident_index.sqlite').load()
+        return self.incident_index
+
+    def get_patient_cache(self) -> PatientColumnCache:
+        """
+        load the columnar patient file cache from self.cache_dir, (re)building
+        it if the patient file has changed since it was cached.
+        :return: loaded PatientColumnCache
+        """
+        if self.patient_cache is None or not self.patient_cache.is_valid():
+            self.patient_cache = PatientColumnCache(self.file_paths['patient'], self.cache_dir).load()
+        return self.patient_cache
+
+    def get_outbreak_ner_cache(self) -> OutbreakNERCache:
+        """
+        load the cache of entities found in outbreak names from self.cache_dir
+        :return: loaded OutbreakNERCache
+        """
+        if self.outbreak_ner_cache is None:
+            self.outbreak_ner_cache = OutbreakNERCache(self.cache_dir / 'outbreak_ner_cache.json',
+                                                       signature=self.nlp.signature()).load()
+        return self.outbreak_ner_cache
 
                    
+    def read_wedss_text(self, ids:Dict, incident_index:WedssIncidentIndex=None,
+                        workers:int=None, progress=True) -> Dict:
+        """
+        concatenate all related fields in all files for each incidentID in ids
+        :param ids: dict of {incidentID:1}
+        :param incident_index: optional loaded WedssIncidentIndex to read only
+        the rows for ids with
+        :param workers: number of processes reading files, default self.ingest_workers
+        :param progress: if True show a progress bar over the files
+        :return: dict {incidentID:"all.values.associated.with.that.incident.in.all.files"}
+        """
+        # stream every file in files list, collecting the relevant column
+        # values per incidentID into lists that are joined once at the end.
+        buffers={}
+        files = self.file_paths['all']
+        workers = workers or self.ingest_workers
+        if workers > 1 and len(files) > 1:
+            # files are independent - parse them in parallel, results come
+            # back in file order so the merged text is the same as serially
+            with ProcessPoolExecutor(max_workers=min(workers, len(files))) as pool:
+                results = list(tqdm(pool.map(collect_text_fragments, files,
+                                             repeat(self.nlp_fields),
+                                             repeat(ids),
+                                             repeat(incident_index)),
+                                    total=len(files), disable=not progress))
+        else:
+            results = (collect_text_fragments(file, self.nlp_fields, ids, incident_index)
+                       for file in tqdm(files, disable=not progress))
+        for fragments in results:
+            for incident_id, pieces in fragments.items():
+                if incident_id not in buffers:
+                    buffers[incident_id]=pieces
+                else:
+                    buffers[incident_id].extend(pieces)
+
+        return {k:''.join(v) for k,v in buffers.items()}
+
     def get_text_from_wedds_files(self):
         """
         This function gets the list of incidentIDs and concatenates 
@@ -472,122 +636,240 @@ class ApolloDetector():
         :param ids: dict of {incidentID:1}
         :return: self.raw_wedss_text dict {incidentID:"all.values.associated.with.that.incident.in.all.files"}
         """
-        self.raw_wedss_text={}
-       
-        # iterate over all files in files list, 
+        incident_index = self.get_incident_index() if self.cache_dir else None
         logger.info(f"reading in WEDSS files: {self.file_paths['all']}")
-        for file in tqdm(self.file_paths['all']):
-            with file.open('r', encoding='ISO-8859-1') as f:
-                f.seek(0)
-                lines=f.readlines()
-                hdic={}
-                
-                # iterate over every line in a file
-                for counter, line in tqdm(enumerate(lines)):
-                    header_row = False
-                    if counter == 0:
-                        header_row=True
-                    ls=line.split("|")
-                    incident_id = ls[0]
-                    
-                    # determine which columns are relevant in this file, make dict hdic
-                    # for the first line in a file add all values to hdic {'header val':1}
-                    # IF those header values in the NLPFields.csv file, or contain "_Sec".
-                    if header_row:
-                        for i in range(0,len(ls)):
-                            if ls[i] in self.nlp_fields or "_Sec" in ls[i]:
-                                hdic[i]=1
-                                
-                    # for non-header/first file rows, if row has id in list of ids passed to fn
-                    # concatenate all values of all columns in that file that were in the NLPFields.csv file
-                    # concatenated into a string separated by '.'. 
-                    else:
-                        tmp=''
-                        if incident_id in self.ids:
-                            for key in hdic:
-                                try:
-                                    tmp=tmp+'|'+ls[key]
-                                except:
-                                    pass
-                            
-                            # if incidentID its not in self.raw_wedss_text dict already, 
-                            # append it and associated text, else just extend text.
-                            if incident_id not in self.raw_wedss_text:
-                                self.raw_wedss_text[incident_id]=tmp
-                            else:
-                                self.raw_wedss_text[incident_id]+=tmp 
+        self.raw_wedss_text = self.read_wedss_text(self.ids, incident_index)
                                 
         self.dict_to_csv(self.raw_wedss_text, 
                          columns=["IncidentID","Text"], 
                          file_name="wedds_text_per_incident")
         
-    def wedss_text_filter(self) -> Dict:
+    def wedss_text_filter(self, raw_wedss_text:Dict=None) -> Dict:
         """
         filter meaningless input before NER pipeline
         filters out incidents with no text, WEDSS timestamps where there is 
-        text 
+        text, using the rules in self.text_cleaner
+        :param raw_wedss_text: {incidentID: text} to filter, default self.raw_wedss_text
         :return: filtered raw_wedss_text Dict
         """
+        if raw_wedss_text is None:
+            raw_wedss_text = self.raw_wedss_text
         processed_wedss_text = {}
-        # TODO: load rules from a config file
-        for k, v in self.raw_wedss_text.items():
-            # skip incidents with no text
-            if not re.match(r"^[|]+(\r\n|\r|\n)[|]+$", v):
-                # remove WEDSS timestamps where there is text
-                v = re.sub(r"(Mon|Tue|Wed|Thu|Fri|Sat|Sun) (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) \d?\d (19|20)\d\d \d\d:\d\d:\d\d GMT-0\d00 \(Central (Standard|Daylight) Time\)", 
-                           '', 
-                           v)
-                v = re.sub(r"Central Daylight Time", '', v)
-                # remove |Y(|Y|Y|Y...) from input text
-                v = re.sub(r"(\|[Y])+", '', v)
-                
-                # remove contact tracers names: ORGLast, First 
-                v = re.sub(r"MAXIM\w+, \w+,", '', v)
-                v = re.sub(r"UHS\w+, \w+,", '', v)
-                v = re.sub(r' MAXIM ', ' ', v)
-                v = re.sub(r'Covid19.+, .+,', ' ', v)
-                v = re.sub(r'MHDCOV\w+(, \w+)?', ' ', v)
-                v = re.sub(r'[Pp]acifi[\w]+ [Ii]nterp[\w]+', ' ', v)
-                
+        self.text_cleaner.reset_stats()
+        for k, v in raw_wedss_text.items():
+            v = self.text_cleaner.clean(v)
+            # skip rules drop incidents, e.g. with no text
+            if v is not None:
                 processed_wedss_text[k] = v
         
         self.dict_to_csv(processed_wedss_text, 
                          ['incidentID', 'Processed WEDDS Text'], 
                          'processed_WEDDS_text')
+        self.dict_to_csv(self.text_cleaner.get_rule_stats(),
+                         ['rule', 'action', 'hits', 'seconds'],
+                         'text_cleaning_statistics')
         
         return processed_wedss_text
 
 
-    def BERTNER(self, output:Dict, stats_output=False) -> Dict:
+    def BERTNER(self, output:Dict, stats_output=False, distributed=False) -> Dict:
         """
         run BERT NER pipeline on text for every incident id
         :param output: dict {incidentID: "all text from NLPFields.csv fields concatenated"}
+        :param distributed: if True and distributed_dir is set, shard the
+        texts over distributed_ner workers, for incident text rather than
+        the few short outbreak names
         :return: dict {incidentID: [[Names], [Types], [Scores]]}
         """
         out={}
         print('kick off NER processing...')
-        for key, actual_text in tqdm(output.items()):
-            out[key] = self.nlp.ner_over_chunks(actual_text)
-            # progress(out)
+        keys = list(output.keys())
+        with tqdm(total=len(keys)) as progress:
+            if distributed and self.distributed_dir:
+                out.update(ner_over_texts_distributed(self.nlp, output, self.distributed_dir,
+                                                      units=self.distributed_units,
+                                                      progress=progress.update))
+            elif self.ner_workers > 1:
+                results = self.nlp.ner_over_texts_parallel([output[key] for key in keys],
+                                                           self.ner_workers,
+                                                           progress=progress.update)
+                out.update(zip(keys, results))
+            else:
+                # hand the pipeline many batches worth of incidents at a time,
+                # so it has windows of similar length to batch together
+                incidents_per_call = 32*self.nlp.batch_size
+                for i in range(0, len(keys), incidents_per_call):
+                    batch_keys = keys[i:i+incidents_per_call]
+                    batch_results = self.nlp.ner_over_texts([output[key] for key in batch_keys])
+                    out.update(zip(batch_keys, batch_results))
+                    progress.update(len(batch_keys))
         
         if stats_output:
             self.dict_to_csv(self.nlp.get_token_stats(),
                              columns=['stat','value'],
                              file_name='token_statistics')
        
-        # # return(dask.compute(out)[0]) 
         return(out)
  
     
     def process_text_for_entities(self):
         """
         process raw text per incident ID to NER results per incidentID
+        with an incremental store only incidents that are new or whose text
+        changed since they were stored are run through NER, the stored
+        results are reused for the rest. The text of every incident is still
+        filtered, so processed_WEDDS_text and text_cleaning_statistics cover
+        the whole report.
+        """
+        if not self.incremental_store:
+            processed_wedss_text = self.wedss_text_filter()
+            self.ner_results = self.BERTNER(processed_wedss_text, stats_output=True, distributed=True)
+        else:
+            changed, reused, hashes = self.incremental_store.split(self.raw_wedss_text)
+            processed_wedss_text = self.wedss_text_filter()
+            changed_text = {k: processed_wedss_text[k] for k in changed if k in processed_wedss_text}
+            # no token statistics when every incident was reused
+            new_results = self.BERTNER(changed_text, stats_output=bool(changed_text), distributed=True)
+            self.incremental_store.update({k: hashes[k] for k in changed}, new_results)
+            # keep incidents in the same order as a full run
+            self.ner_results = {}
+            for k in self.raw_wedss_text:
+                if k in new_results:
+                    self.ner_results[k] = new_results[k]
+                elif reused.get(k) is not None:
+                    self.ner_results[k] = reused[k]
+        self.dict_to_csv(self.ner_results,
+                         columns = ["IncidentID","Names","Types","Scores"],
+                         file_name="ner_results")
+
+    def _iter_wedss_text_blocks(self, block_size:int, incident_index:WedssIncidentIndex=None):
+        """
+        read the WEDSS text of self.ids in blocks of block_size incidents, in
+        the order get_text_from_wedds_files collects them. With an incident
+        index each block is read on its own, without one every file has to be
+        read before any incident's text is complete.
+        :return: iterator of ({incidentID: text},)
+        """
+        if incident_index is None:
+            raw_wedss_text = self.read_wedss_text(self.ids)
+            keys = list(raw_wedss_text)
+            for i in range(0, len(keys), block_size):
+                yield ({k: raw_wedss_text[k] for k in keys[i:i+block_size]},)
+            return
+
+        # sqlite connections can't be shared between threads, the copy opens
+        # its own in the reading thread
+        incident_index = copy.copy(incident_index)
+        try:
+            # incidents in order of their first row in the files
+            order = {}
+            for file in self.file_paths['all']:
+                for incident_id, _, _ in incident_index.locate(file, self.ids):
+                    order.setdefault(incident_id, 1)
+            keys = list(order)
+            for i in range(0, len(keys), block_size):
+                ids = {k: 1 for k in keys[i:i+block_size]}
+                yield (self.read_wedss_text(ids, incident_index, workers=1, progress=False),)
+        finally:
+            incident_index.close()
+
+    def stream_text_to_entities(self):
         """
-        processed_wedss_text = self.wedss_text_filter()
-        self.ner_results = self.BERTNER(processed_wedss_text, stats_output=True)
+        get_text_from_wedds_files then process_text_for_entities as a stream:
+        blocks of incidents flow from the WEDSS reader through text cleaning
+        and NER to the collection of results, each stage in its own thread
+        with bounded queues between them, so reading, cleaning and inference
+        overlap. Writes the same files as the stages run in turn, and
+        pipeline_stage_statistics with the throughput and input queue depth
+        of every stage.
+        """
+        if self.ner_workers > 1:
+            logger.warning('NER runs in one process when streaming, ner_workers is ignored')
+        if self.distributed_dir:
+            logger.warning('NER runs in one process when streaming, distributed_dir is ignored')
+        incident_index = self.get_incident_index() if self.cache_dir else None
+        # as many incidents per NER call as BERTNER hands the pipeline
+        block_size = 32*self.nlp.batch_size
+        self.text_cleaner.reset_stats()
+
+        def clean(item):
+            block = item[0]
+            changed, reused, hashes = block, {}, {}
+            if self.incremental_store:
+                changed, reused, hashes = self.incremental_store.split(block)
+                hashes = {k: hashes[k] for k in changed}
+            # every incident is cleaned for processed_WEDDS_text, only changed ones run through NER
+            processed = {}
+            for k, v in block.items():
+                v = self.text_cleaner.clean(v)
+                # skip rules drop incidents, e.g. with no text
+                if v is not None:
+                    processed[k] = v
+            to_ner = {k: processed[k] for k in changed if k in processed}
+            return block, processed, to_ner, reused, hashes
+
+        def ner(item):
+            to_ner = item[2]
+            keys = list(to_ner)
+            return item + (dict(zip(keys, self.nlp.ner_over_texts([to_ner[k] for k in keys]))),)
+
+        monitor = StageMonitor()
+        self.raw_wedss_text = {}
+        processed_wedss_text = {}
+        new_results = {}
+        hashes = {}
+        self.ner_results = {}
+        print('kick off streaming NER processing...')
+        for block, processed, _, reused, block_hashes, results in run_stages(
+                self._iter_wedss_text_blocks(block_size, incident_index),
+                [('clean', clean), ('ner', ner)],
+                size=lambda item: len(item[0]),
+                queue_size=self.stream_queue_size,
+                monitor=monitor):
+            self.raw_wedss_text.update(block)
+            processed_wedss_text.update(processed)
+            new_results.update(results)
+            hashes.update(block_hashes)
+            # keep incidents in the same order as a full run
+            for k in block:
+                if k in results:
+                    self.ner_results[k] = results[k]
+                elif reused.get(k) is not None:
+                    self.ner_results[k] = reused[k]
+
+        self.dict_to_csv(self.raw_wedss_text, 
+                         columns=["IncidentID","Text"], 
+                         file_name="wedds_text_per_incident")
+        self.dict_to_csv(processed_wedss_text, 
+                         ['incidentID', 'Processed WEDDS Text'], 
+                         'processed_WEDDS_text')
+        self.dict_to_csv(self.text_cleaner.get_rule_stats(),
+                         ['rule', 'action', 'hits', 'seconds'],
+                         'text_cleaning_statistics')
+        # no token statistics when every incident was reused
+        if new_results or not self.incremental_store:
+            self.dict_to_csv(self.nlp.get_token_stats(),
+                             columns=['stat','value'],
+                             file_name='token_statistics')
+        if self.incremental_store:
+            self.incremental_store.update(hashes, new_results)
         self.dict_to_csv(self.ner_results,
                          columns = ["IncidentID","Names","Types","Scores"],
                          file_name="ner_results")
+        self.dict_to_csv(monitor.get_stats(),
+                         ['stage', 'items', 'busy seconds', 'items per busy second',
+                          'mean input queue depth', 'max input queue depth'],
+                         'pipeline_stage_statistics')
+
+    def get_entities_for_ids(self):
+        """
+        WEDSS text and NER results for self.ids, streamed if self.streaming
+        """
+        if self.streaming:
+            self.stream_text_to_entities()
+        else:
+            self.get_text_from_wedds_files()
+            self.process_text_for_entities()
 
     def load_all_outbreak_data(self):
         """
@@ -644,6 +926,7 @@ class ApolloDetector():
         """
         incidents_to_outbreaks = {}
         outbreaks_to_ners = {}
+        outbreaks_to_keys = {}
         for incident_id, row in self.outbreaks.items():
             # map incidentID to outbreakID - only for incident IDs that we're looking at (in out Dict)
 
@@ -652,27 +935,69 @@ class ApolloDetector():
             
             # map outbreakID to pre-NER string incorporating outbreak location information - typically organization name
             # id structure typically all caps YEAR-COUNTY BUSINESS NAME | split into: year County| Business Name| Location
-            # TODO: drop year County here - never informative.
+            # year County is never informative, --outbreak_names rules drops it, see outbreak_parser
             outbreak_location = row['OutbreakLocation']
             preprocessed_outbreak_id = outbreak_id.replace('-',' ').title().split()    
             preprocessed_outbreak_id.insert(2, '|')
             preprocessed_outbreak_id = ' '.join(preprocessed_outbreak_id) + '| ' + outbreak_location
             outbreaks_to_ners[outbreak_id] = preprocessed_outbreak_id
+            # the same names parsed by rules, without the year and county
+            outbreaks_to_keys[outbreak_id] = outbreak_match_keys(outbreak_id, outbreak_location)
 
+        if self.outbreak_names == 'rules':
+            self.outbreak_stats['associated outbreak count'] = len(outbreaks_to_keys)
+            return incidents_to_outbreaks, outbreaks_to_keys
            
         # replaced preprocessed_outbreaks_ids with NER results
         # dict of outbreakbreakidL NERS for htat outbreak - for all outbreaks that can be linked to a current/relevant incidentID
-        outbreaks_to_ners = self.BERTNER(outbreaks_to_ners)
-        
-        # limit NER results to just the entities, remove the types and scores.
-        # TODO: confirm filtering still necessary here if ((x!="") and (x[0]!="#"), move into NERPipeline
-        for outbreak_id, ner_result in outbreaks_to_ners.items():
-            outbreaks_to_ners[outbreak_id] = [x for x in outbreaks_to_ners[outbreak_id][0] if ((x!="") and (x[0]!="#"))]
+        if not self.cache_dir:
+            outbreaks_to_ners = self.BERTNER(outbreaks_to_ners)
+            
+            # limit NER results to just the entities, remove the types and scores.
+            for outbreak_id, ner_result in outbreaks_to_ners.items():
+                outbreaks_to_ners[outbreak_id] = outbreaks_to_ners[outbreak_id][0]
+        else:
+            # only new outbreaks, or those with a changed name or location, go through NER
+            outbreak_ner_cache = self.get_outbreak_ner_cache()
+            cached = {}
+            for outbreak_id, preprocessed_outbreak_id in outbreaks_to_ners.items():
+                entities = outbreak_ner_cache.get(outbreak_id, preprocessed_outbreak_id)
+                if entities is not None:
+                    cached[outbreak_id] = entities
+            missed = {k: v for k, v in outbreaks_to_ners.items() if k not in cached}
+            new_results = self.BERTNER(missed) if missed else {}
+            for outbreak_id, preprocessed_outbreak_id in missed.items():
+                outbreak_ner_cache.put(outbreak_id, preprocessed_outbreak_id, new_results[outbreak_id][0])
+            if missed:
+                outbreak_ner_cache.save()
+            self.outbreak_stats['outbreak ner cache hits'] = len(cached)
+            self.outbreak_stats['outbreak ner cache misses'] = len(missed)
+            outbreaks_to_ners = {k: cached[k] if k in cached else new_results[k][0] for k in outbreaks_to_ners}
+
+        if self.outbreak_names == 'compare':
+            self.compare_outbreak_names(outbreaks_to_ners, outbreaks_to_keys)
         
         self.outbreak_stats['associated outbreak count'] = len(outbreaks_to_ners)
         
         return incidents_to_outbreaks, outbreaks_to_ners
                                
+    def compare_outbreak_names(self, outbreaks_to_ners:Dict, outbreaks_to_keys:Dict):
+        """
+        write the agreement between the entities NER finds in outbreak names
+        and the names outbreak_parser gets from them, per outbreak, and the
+        share of outbreaks they agree on to outbreak_stats
+        :param outbreaks_to_ners: {outbreakID: [entities]}
+        :param outbreaks_to_keys: {outbreakID: [parsed names]}
+        """
+        agreement = compare_outbreak_keys(outbreaks_to_ners, outbreaks_to_keys)
+        same = sum(1 for v in agreement.values() if v[2])
+        matched = sum(1 for v in agreement.values() if v[3])
+        self.outbreak_stats['outbreak names same by bert and rules pc'] = round(100*same/len(agreement), 2) if agreement else 0
+        self.outbreak_stats['outbreak names matched by bert and rules pc'] = round(100*matched/len(agreement), 2) if agreement else 0
+        self.dict_to_csv(agreement,
+                         ['Outbreak#', 'BERT entities', 'rule names', 'same names', 'names match'],
+                         'outbreak_name_agreement')
+
     def find_associated_known_outbreak_ids(self, namedic:Dict) -> Dict:
         """
         for a given dictionary of NER entities and associated incidentIDs find all known outbreak IDs associated with that key and incidentIDs
@@ -690,30 +1015,29 @@ class ApolloDetector():
         # outbreak_ids_by_entity = {}  #{ entity:[list of outbreak ids]}
         outbreak_data_by_entity = {}  #{ entity: [lsit of outbrek dicts]}
         for key in namedic:
-            if key!="" and key[0]!="#":
-                # set up empty list to append to
-                outbreak_data_by_entity[key] = []
-                # get all incident ids associated with each NER entity/key
-                incident_id_strs = [str(x).strip() for x in namedic[key]]
-                for incident_id in incident_id_strs:
-                    try:
-                        # if an outbreak NER entity associated with an incident ID matches the key - store that outbreak ID
-                        for entity in outbreaks_to_ners[incidents_to_outbreaks[incident_id]]:
-                            # if key.strip() == entity.strip():
-                            if fuzz.partial_ratio(entity, key) >= outbreak_match_ratio:
-                                # logger.debug(f"key: {key}, incident_id:'{incident_id}'")
-                                # outbreak_ids_by_entity[key].append(incidents_to_outbreaks[incident_id])
-                                if self.outbreaks[incident_id]:
-                                    outbreak_data_by_entity[key].append(self.outbreaks[incident_id]) # [{}, {}, {}] i.e. append a dictionary.
-                                break
-                            else:
-                                pass
-                                # outbreak_ids_by_entity[key].append('no match')
+            # set up empty list to append to
+            outbreak_data_by_entity[key] = []
+            # get all incident ids associated with each NER entity/key
+            incident_id_strs = [str(x).strip() for x in namedic[key]]
+            for incident_id in incident_id_strs:
+                try:
+                    # if an outbreak NER entity associated with an incident ID matches the key - store that outbreak ID
+                    for entity in outbreaks_to_ners[incidents_to_outbreaks[incident_id]]:
+                        # if key.strip() == entity.strip():
+                        if fuzz.partial_ratio(entity, key) >= outbreak_match_ratio:
+                            # logger.debug(f"key: {key}, incident_id:'{incident_id}'")
+                            # outbreak_ids_by_entity[key].append(incidents_to_outbreaks[incident_id])
+                            if self.outbreaks[incident_id]:
+                                outbreak_data_by_entity[key].append(self.outbreaks[incident_id]) # [{}, {}, {}] i.e. append a dictionary.
+                            break
+                        else:
+                            pass
+                            # outbreak_ids_by_entity[key].append('no match')
                                 
-                    except (KeyError):
-                        # logger.debug('entity %s not found in outbreak id search process', key)
-                        # outbreak_ids_by_entity[key].append('no match')
-                        pass
+                except (KeyError):
+                    # logger.debug('entity %s not found in outbreak id search process', key)
+                    # outbreak_ids_by_entity[key].append('no match')
+                    pass
         
         # for outbreak in outbreak_ids_by_entity:            
         unique_outbreaks_data = {}
@@ -909,9 +1233,7 @@ class ApolloDetector():
         namedic = self.apply_stop_entities_rules(namedic)
         
         for key in namedic:
-            if key!="" \
-               and key[0]!="#" \
-               and typedic[key] != 'Person' \
+            if typedic[key] != 'Person' \
                and key.strip() not in self.stop_entities:
 
                 incident_id_strs = [str(x).strip() for x in namedic[key]] 
@@ -1314,16 +1636,83 @@ class ApolloDetector():
         :returns: None.
         """
         self.get_ids(target_date=report_date, period=period)
-        self.get_text_from_wedds_files()
-        self.process_text_for_entities()
+        self.get_entities_for_ids()
         self.create_stop_entities()
-        self.create_report()     
-        
+        self.create_report()
+
+    def run_pipeline_multi(self, periods:List[Tuple[str, str]], prefixes:List[str]=None,
+                           search_county:str='Dane'):
+        """
+        Run APOLLO detector for several report periods, e.g. each month of a
+        year, reading the WEDSS extracts and running NER only once.
+
+        Incidents for every period are found in one pass over the patient
+        data, WEDSS text and NER results are produced once for the union of
+        those incidents, then a final report is written per period from the
+        shared results.
+
+        :param periods: list of (report_date, period) tuples, see run_pipeline
+        :type periods: List[Tuple[str, str]]
+        :param prefixes: file name prefix per period, added after this
+        detector's file_prefix. default: the period's report_date and period,
+        e.g. 2021-05-31_month
+        :type prefixes: List[str]
+        :param search_county: county to search in for incidents
+        :returns: None.
+        :raises ValueError: if the prefixes aren't one per period or two periods
+        share a prefix, the later report would overwrite the earlier
+        """
+        if not prefixes:
+            prefixes = [f'{report_date}_{period}' for report_date, period in periods]
+        if len(prefixes) != len(periods):
+            raise ValueError(f'{len(prefixes)} prefixes given for {len(periods)} periods')
+        duplicates = sorted(prefix for prefix, n in Counter(prefixes).items() if n > 1)
+        if duplicates:
+            raise ValueError(f'periods must have different prefixes, {duplicates} given more than once')
+
+        date_periods = [DatePeriod(report_date, period) for report_date, period in periods]
+        selections = self.select_ids_by_period(date_periods, search_county)
+
+        ids_by_period = []
+        all_ids = {}
+        for (report_date, period), (matches, any_counter) in zip(periods, selections):
+            ids = {}
+            for incidentID in matches:
+                ids[incidentID] = 1
+                all_ids[incidentID] = 1
+            ids_by_period.append(ids)
+            print(f'{report_date} {period}: total any status cases, in {search_county} county: {any_counter}')
+            print(f'{report_date} {period}: total confirmed cases, in {search_county} county: {len(matches)}')
+        logger.info(f'running NER over {len(all_ids)} incidents for {len(periods)} periods')
+
+        # one extract scan and one NER pass over every incident in any period
+        self.ids = all_ids
+        self.get_entities_for_ids()
+
+        all_ner_results = self.ner_results
+        file_prefix = self.file_prefix
+        stop_entities = getattr(self, 'stop_entities', None)
+        try:
+            for (report_date, period), date_period, ids, prefix in zip(
+                    periods, date_periods, ids_by_period, prefixes):
+                print(f'NOW REPORTING {report_date} {period}')
+                self.date_period = date_period
+                self.date_range = date_period.dates
+                self.ids = ids
+                self.ner_results = {k: all_ner_results[k] for k in ids if k in all_ner_results}
+                self.file_prefix = file_prefix + prefix + '_'
+                # create_stop_entities extends the list, start each period afresh
+                self.stop_entities = list(stop_entities) if stop_entities else stop_entities
+                self.create_stop_entities()
+                self.create_report()
+        finally:
+            self.file_prefix = file_prefix
+            self.ner_results = all_ner_results
+
     def generate_stop_entities(self, period):
         self.stop_entities=None
         self.get_ids('1900-01-01', period='all')
-        self.get_text_from_wedds_files()
-        self.process_text_for_entities()
+        self.get_entities_for_ids()
         self.create_stop_entities(min_df=0)
         
         
@@ -1336,7 +1725,25 @@ class ApolloDetector():
 @click.option('--report_date', type=str, help = 'YYYY-MM-DD formatted date to run the pipeline on, default to today')
 @click.option('--period', type=str, default='trailing_seven_days', help = 'type of date period to run: week, trailing_seven_days, month, all')
 @click.option('--final_report_only/--no-final_report_only', default=True, help = 'only output final report file')
-def main(input_path, output_path, nlp_fields, stop_entities, prefix, final_report_only, report_date, period):
+@click.option('--cache_dir', type=click.Path(), help = 'dir for on-disk caches of WEDSS extract data and outbreak name entities, default: no caching')
+@click.option('--ingest_workers', type=int, default=1, help = 'number of processes reading WEDSS files in parallel')
+@click.option('--text_rules', type=click.Path(exists=True), default='supporting_data/text_cleaning_rules.csv', help = 'csv file of text cleaning rules')
+@click.option('--dedup_segments/--no-dedup_segments', default=False, help = 'run NER once over text segments repeated within an incident')
+@click.option('--ner_batch_size', type=int, default=8, help = 'number of text chunks run through the NER model per forward pass')
+@click.option('--ner_stride', type=int, default=64, help = 'number of tokens consecutive NER windows overlap by')
+@click.option('--ner_cache', type=click.Path(), help = 'SQLite file caching NER model predictions across runs, default: no caching')
+@click.option('--ner_cache_max_mb', type=int, default=1024, help = 'size in MB above which the NER cache evicts least recently used entries')
+@click.option('--ner_backend', type=click.Choice(['torch', 'torch_int8', 'onnx']), default='torch', help = 'NER inference backend: PyTorch fp32, PyTorch dynamic INT8 or ONNX Runtime')
+@click.option('--ner_workers', type=int, default=1, help = 'number of processes running NER, sharing one loaded model')
+@click.option('--distributed_dir', type=click.Path(), help = 'dir shared with distributed_ner.py workers on any hosts to shard NER over, default: NER runs on this host only')
+@click.option('--distributed_units', type=int, default=64, help = 'number of work units distributed NER is sharded into')
+@click.option('--ner_gate/--no-ner_gate', default=False, help = 'skip the NER model for text chunks a rule based check finds no possible entities in')
+@click.option('--ner_gate_check_every', type=int, default=100, help = 'run the NER model over every nth chunk the gate skips to count missed entities, 0 for never')
+@click.option('--streaming/--no-streaming', default=False, help = 'read, clean and run NER over WEDSS text concurrently as a stream of incident blocks')
+@click.option('--stream_queue_size', type=int, default=4, help = 'most incident blocks waiting in front of each streaming stage')
+@click.option('--outbreak_names', type=click.Choice(['bert', 'rules', 'compare']), default='bert', help = 'get outbreak names to match entities against with NER, with rules, or with NER and a report of its agreement with the rules')
+@click.option('--incremental_store', type=click.Path(), help = 'SQLite file of NER results reused for incidents unchanged since a previous run, default: no reuse')
+def main(input_path, output_path, nlp_fields, stop_entities, prefix, final_report_only, report_date, period, cache_dir, ingest_workers, incremental_store, text_rules, dedup_segments, ner_batch_size, ner_stride, ner_cache, ner_cache_max_mb, ner_backend, ner_workers, distributed_dir, distributed_units, ner_gate, ner_gate_check_every, streaming, stream_queue_size, outbreak_names):
     """
     Run the APOLLO pipeline
     """
@@ -1350,7 +1757,25 @@ def main(input_path, output_path, nlp_fields, stop_entities, prefix, final_repor
                               nlp_fields_file = nlp_fields,
                               stop_entities_file = stop_entities,
                               file_prefix=prefix,
-                              final_report_only=final_report_only)
+                              final_report_only=final_report_only,
+                              cache_dir=cache_dir,
+                              ingest_workers=ingest_workers,
+                              incremental_store=incremental_store,
+                              text_rules_file=text_rules,
+                              dedup_segments=dedup_segments,
+                              ner_batch_size=ner_batch_size,
+                              ner_stride=ner_stride,
+                              ner_cache=ner_cache,
+                              ner_cache_max_mb=ner_cache_max_mb,
+                              ner_backend=ner_backend,
+                              ner_workers=ner_workers,
+                              distributed_dir=distributed_dir,
+                              distributed_units=distributed_units,
+                              ner_gate=ner_gate,
+                              ner_gate_check_every=ner_gate_check_every,
+                              streaming=streaming,
+                              stream_queue_size=stream_queue_size,
+                              outbreak_names=outbreak_names)
     
     if not report_date: 
         report_date = date.today().strftime('%Y-%m-%d')
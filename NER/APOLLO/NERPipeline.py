@@ -1,27 +1,148 @@
-from transformers import AutoTokenizer, AutoModelForTokenClassification
-from transformers import pipeline
-import statistics
+import numpy as np
+import bisect
+import multiprocessing
+import os
 import re
-from typing import List, Dict
+from typing import List, Dict, Tuple
 
-# TODO: fix entity output from NERPipeline:
-# TODO: no ''
-# TODO: ammend output that is 'B' and '##ad' - revisit grouped_entities setting.
+from ner_cache import NERChunkCache, model_fingerprint
+from model_registry import DEFAULT_MODEL_PATH, LoadedNERModel, get_model_config, get_ner_model
+from token_statistics import TokenStatistics
+
+# NERPipeline shared copy-on-write with forked NER workers, see ner_over_texts_parallel
+_worker_pipeline = None
+
+
+def _init_ner_worker(threads:int):
+    _worker_pipeline.backend.set_num_threads(threads)
+    if _worker_pipeline.cache:
+        _worker_pipeline.cache.reconnect()
+
+
+def _ner_work_unit(unit):
+    """
+    run ner_over_texts in a forked worker
+    :param unit: (index of the first text, list of texts)
+    :return: index of the first text, then NERPipeline.ner_over_unit's results
+    """
+    first, texts = unit
+    return (first,) + _worker_pipeline.ner_over_unit(texts)
+
+# fewest letters a window needs to pass the NER gate
+GATE_MIN_LETTERS = 3
+
+# entity type reported for the suffix of the model's B- and I- labels
+ENTITY_TYPES = {'ORG': 'Organization', 'PER': 'Person', 'LOC': 'Location', 'MISC': 'Miscellaneous'}
 
 class NERPipeline(object):
     """
+    The model is not loaded until the first inference call, and then comes
+    from model_registry, which loads each model once per process.
+
     attributes:
-    self.tokenizer AutoTokenizer from_pretrained "APOLLO/bert-base-NER"
-    self.model = AutoModelForTokenClassification from_pretrained "APOLLO/bert-base-NER"
-    self.nlp transformers pipeline of the tokenizer and model
-    self.tokens = []
+    self.model_path directory of the model and tokenizer, default "APOLLO/bert-base-NER"
+    self.tokenizer AutoTokenizer from_pretrained self.model_path
+    self.model = AutoModelForTokenClassification from_pretrained self.model_path
+    self.id2label model output index to entity label, e.g. 'B-PER'
+    self.entity_types entity type names, see ENTITY_TYPES
+    self.vocab_size size of the model's vocabulary
+    self.tokens = [] token ids of every text, only kept if keep_tokens
+    self.entities = [] entities of every text, only kept if keep_tokens
+    self.token_stats TokenStatistics of every text's tokens, kept in
+    constant memory whatever the number of texts
+    self.dedup_segments if True collapse repeated segments of a text before NER
+    self.dedup_stats segment and token counts of the collapsed segments
+    self.gate if True skip the model for windows that fail a rule based
+    check for possible entities, see _may_contain_entities
+    self.gate_check_every run the model over every nth skipped window anyway
+    to count those that would have yielded entities, 0 for never
+    self.gate_stats counts of the windows skipped and checked
+    self.padding_stats counts of real and padded token positions run through the model
+    self.batch_size number of windows run through the model per forward pass
+    self.max_tokens most tokens of text in one window, the model's maximum
+    sequence length less its special tokens
+    self.stride number of tokens consecutive windows overlap by
+    self.cache optional NERChunkCache of model predictions per window
+    self.backend_name inference backend, one of ner_backends.BACKENDS
+    self.backend ner_backends backend computing the model's logits
     """
-    def __init__(self):
-        self.tokenizer = AutoTokenizer.from_pretrained("APOLLO/bert-base-NER", local_files_only=True)
-        self.model = AutoModelForTokenClassification.from_pretrained("APOLLO/bert-base-NER", local_files_only=True)
-        self.nlp = pipeline("ner",model=self.model,tokenizer=self.tokenizer)  #, grouped_entities=True)
+    def __init__(self, dedup_segments:bool=False, batch_size:int=1, stride:int=64,
+                 cache_path:str=None, cache_max_mb:int=1024, backend:str='torch',
+                 keep_tokens:bool=False, model_path:str=DEFAULT_MODEL_PATH,
+                 gate:bool=False, gate_check_every:int=100):
+        self.model_path = model_path
+        self.backend_name = backend
+        self._loaded = None
+        self._fingerprint = None
+        self.vocab_size = get_model_config(model_path)['vocab_size']
+        self.keep_tokens = keep_tokens
         self.tokens = []
         self.entities = []
+        self.token_stats = TokenStatistics(self.vocab_size)
+        self.dedup_segments = dedup_segments
+        self.dedup_stats = {'segments': 0, 'duplicate segments': 0, 'duplicate tokens': 0}
+        self.gate = gate
+        self.gate_check_every = gate_check_every
+        self.gate_stats = {'windows': 0, 'skipped windows': 0, 'skipped tokens': 0,
+                           'checked windows': 0, 'checked windows with entities': 0}
+        self.padding_stats = {'batches': 0, 'tokens': 0, 'padded positions': 0}
+        self.batch_size = batch_size
+        if stride < 0:
+            raise ValueError(f'stride must be at least 0, not {stride}')
+        self.stride = stride
+        self.cache = None
+        if cache_path:
+            self.cache = NERChunkCache(cache_path,
+                                       model_fingerprint(model_path, backend),
+                                       max_bytes=cache_max_mb*1024*1024)
+
+    def _load(self) -> LoadedNERModel:
+        """
+        :return: the model from model_registry, loaded on the first call
+        """
+        if self._loaded is None:
+            loaded = get_ner_model(self.model_path, self.backend_name)
+            max_tokens = (min(loaded.tokenizer.model_max_length, loaded.model.config.max_position_embeddings)
+                          - loaded.tokenizer.num_special_tokens_to_add())
+            if not self.stride < max_tokens//2:
+                raise ValueError(f'stride must be less than {max_tokens//2}, not {self.stride}')
+            self._set_labels([loaded.model.config.id2label[k] for k in range(len(loaded.model.config.id2label))])
+            self._loaded = loaded
+            self._max_tokens = max_tokens
+        return self._loaded
+
+    def _set_labels(self, labels:List):
+        """
+        per label index: index into self.entity_types, -1 for 'O', and
+        whether the label begins an entity
+        :param labels: the model's labels in label index order, e.g. 'O', 'B-PER'
+        """
+        self.entity_types = sorted(set(ENTITY_TYPES.get(label[2:], label[2:]) for label in labels if label != 'O'))
+        self._label_types = np.array([-1 if label == 'O' else self.entity_types.index(ENTITY_TYPES.get(label[2:], label[2:]))
+                                      for label in labels])
+        self._label_begins = np.array([label.startswith('B-') for label in labels])
+        self._o_label = labels.index('O')
+
+    @property
+    def tokenizer(self):
+        return self._load().tokenizer
+
+    @property
+    def model(self):
+        return self._load().model
+
+    @property
+    def backend(self):
+        return self._load().backend
+
+    @property
+    def id2label(self) -> Dict:
+        return self._load().model.config.id2label
+
+    @property
+    def max_tokens(self) -> int:
+        self._load()
+        return self._max_tokens
         
     def flatten(self, lol:List) -> List:
         """
@@ -41,27 +162,32 @@ class NERPipeline(object):
     #     self.tokens.append(self.tokenizer(txt)['input_ids'])
     def _store_tokens(self, tokens:List):
         """
-        store tokens in object attribute
+        count tokens in self.token_stats, and store them in object attribute
+        if self.keep_tokens
         :param tokens : List of tokens
         :type tokens: list
         :return: None.
         """
-        self.tokens.append(tokens)
+        self.token_stats.add(tokens)
+        if self.keep_tokens:
+            self.tokens.append(tokens)
     
     def _store_entities(self, entities:List):
         """
-        store entites in object attribute
+        store entites in object attribute if self.keep_tokens
         :param tokens : List of tokens
         :type tokens: list
         :return: None.
         """
-        self.entities.append(entities)
+        if self.keep_tokens:
+            self.entities.append(entities)
         
     def delete_tokens(self):
         """
-        erase collected tokens list
+        erase collected tokens list and token statistics
         """
         self.tokens = []
+        self.token_stats = TokenStatistics(self.vocab_size)
 
     def delete_entities(self):
         """
@@ -94,162 +220,492 @@ class NERPipeline(object):
         """
         returns Dict of token statistics
         """
-        token_stats={}
-
-        document_lengths = []
-        doc_tokens = []
-        for tokens in self.tokens:
-            document_lengths.append(len(tokens))
-            doc_tokens.append(tokens)
-
-        token_stats['total_doc_count'] = len(document_lengths)
-        token_stats['total tokens'] = sum(document_lengths)
-        token_stats['total unique tokens'] = len(set(self.flatten(doc_tokens)))
-        median = statistics.median(document_lengths)
-        LQ = statistics.median([x for x in document_lengths if x <= median])
-        UQ = statistics.median([x for x in document_lengths if x >= median])
-        token_stats['token count median'] = median
-        token_stats['token count lower quartile'] = LQ
-        token_stats['token count upper quartile'] = UQ
-        token_stats['token count IQR'] = UQ-LQ
+        token_stats = self.token_stats.get_stats()
+        if self.dedup_segments:
+            # tokens never sent through NER because their segment was a duplicate
+            token_stats['dedup segments'] = self.dedup_stats['segments']
+            token_stats['dedup duplicate segments removed'] = self.dedup_stats['duplicate segments']
+            token_stats['dedup tokens saved'] = self.dedup_stats['duplicate tokens']
+            all_tokens = token_stats['total tokens'] + self.dedup_stats['duplicate tokens']
+            token_stats['dedup tokens saved pc'] = round(100*self.dedup_stats['duplicate tokens']/all_tokens, 2) if all_tokens else 0
+        if self.gate:
+            # windows never run through the model, and how many of a checked
+            # sample of them the model would have found entities in
+            token_stats['ner gate windows'] = self.gate_stats['windows']
+            token_stats['ner gate windows skipped'] = self.gate_stats['skipped windows']
+            token_stats['ner gate tokens skipped'] = self.gate_stats['skipped tokens']
+            checked = self.gate_stats['checked windows']
+            token_stats['ner gate skipped windows checked'] = checked
+            token_stats['ner gate checked windows with entities'] = self.gate_stats['checked windows with entities']
+            token_stats['ner gate checked windows with entities pc'] = round(100*self.gate_stats['checked windows with entities']/checked, 2) if checked else 0
+        # share of the positions in model batches that hold real tokens
+        token_stats['model batches'] = self.padding_stats['batches']
+        positions = self.padding_stats['padded positions']
+        token_stats['padding efficiency pc'] = round(100*self.padding_stats['tokens']/positions, 2) if positions else 0
+        if self.cache:
+            token_stats.update(self.cache.get_stats())
         return token_stats
         
+    def _predict(self, window_inputs:List, batch_size:int) -> List:
+        """
+        run the model over token id sequences with self.backend, batch_size
+        sequences per forward pass. Sequences are batched in order of length
+        so each batch is padded as little as possible.
+        :param window_inputs: list of token id lists, special tokens included
+        :return: list of (label index array, score array), one per sequence
+        in the order given, scores are the softmax probability of the
+        predicted label
+        """
+        predictions = [None]*len(window_inputs)
+        by_length = sorted(range(len(window_inputs)), key=lambda i: len(window_inputs[i]))
+        for b in range(0, len(by_length), batch_size):
+            batch_order = by_length[b:b+batch_size]
+            batch = [window_inputs[i] for i in batch_order]
+            longest = max(len(ids) for ids in batch)
+            self.padding_stats['batches'] += 1
+            self.padding_stats['tokens'] += sum(len(ids) for ids in batch)
+            self.padding_stats['padded positions'] += len(batch)*longest
+            input_ids = np.full((len(batch), longest), self.tokenizer.pad_token_id, dtype=np.int64)
+            attention_mask = np.zeros((len(batch), longest), dtype=np.int64)
+            for row, ids in enumerate(batch):
+                input_ids[row, :len(ids)] = ids
+                attention_mask[row, :len(ids)] = 1
+            logits = self.backend.logits(input_ids, attention_mask)
+            # softmax as the transformers token classification pipeline computes it
+            shifted_exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+            probabilities = shifted_exp / shifted_exp.sum(axis=-1, keepdims=True)
+            labels = probabilities.argmax(axis=-1)
+            scores = np.take_along_axis(probabilities, labels[..., None], axis=-1)[..., 0]
+            for row, (i, ids) in enumerate(zip(batch_order, batch)):
+                predictions[i] = (labels[row, :len(ids)], scores[row, :len(ids)])
+        return predictions
+
+    def _cached_predict(self, window_inputs:List, batch_size:int) -> List:
+        """
+        _predict, taking the predictions for windows seen before from
+        self.cache and running the model only over the rest, each distinct
+        window once
+        """
+        if not self.cache:
+            return self._predict(window_inputs, batch_size)
+        keys = [self.cache.key(ids) for ids in window_inputs]
+        found = self.cache.get_many(keys)
+        missing = {}
+        for key, ids in zip(keys, window_inputs):
+            if key not in found and key not in missing:
+                missing[key] = ids
+        if missing:
+            predicted = self._predict(list(missing.values()), batch_size)
+            self.cache.put_many([(key,) + prediction for key, prediction in zip(missing, predicted)])
+            found.update(zip(missing, predicted))
+        return [found[key] for key in keys]
+
     def nerfunc(self, txt):
-        ner_res=self.nlp(txt)
-        # return list of dicts [ {'word': 'China', 'score': 0.9999999, 'entity': 'B-LOC', index: 45 start: 74 end: 79}, {etc}]
-        output=[]
-        scores=[]
-        types=[]
-        tmp=''  #store word to build up sequence.
-        s=0  # score tracking
-        t=''  # entity types
-        counter=1
-        # print(f'ner_res: {ner_res}')
-        for word_count, rec in enumerate(ner_res):
-            # print(f'rec :{rec}')
-            if rec['word'][0] == '#':
-                tmp+=rec['word'][2:]
-                if word_count == len(ner_res)-1:
-                    # print(f'final tmp: {tmp}')           
-                    output.append(tmp)
-                    scores.append(s/counter)
-                    types.append(t)
-                    tmp=rec['word']
-                    s=rec['score']
-                    if rec['entity']=='B-ORG':
-                        t='Organization'
-                    if rec['entity']=='B-PER':
-                        t='Person'
-                    if rec['entity']=='B-LOC':
-                        t='Location'
-                    if rec['entity']=='B-MISC':
-                        t='Miscellaneous'
-                continue
-            
-            if 'B-' in rec['entity']:
-                # print(f'intermediate tmp: {tmp}')  
-                output.append(tmp)
-                scores.append(s/counter)
-                types.append(t)
-                tmp=rec['word']
-                s=rec['score']
-                if rec['entity']=='B-ORG':
-                    t='Organization'
-                if rec['entity']=='B-PER':
-                    t='Person'
-                if rec['entity']=='B-LOC':
-                    t='Location'
-                if rec['entity']=='B-MISC':
-                    t='Miscellaneous'
+        encoding = self.tokenizer(txt, add_special_tokens=False, return_offsets_mapping=True)
+        input_ids = [self.tokenizer.cls_token_id] + encoding['input_ids'] + [self.tokenizer.sep_token_id]
+        labels, scores = self._predict([input_ids], 1)[0]
+        output, types, scores, _ = self.decode_entities(txt, encoding['input_ids'], encoding.word_ids(),
+                                                        encoding['offset_mapping'], labels[1:-1], scores[1:-1])
+        return(output,types,scores, input_ids)
+
+    def decode_entities(self, text:str, input_ids:List, word_ids:List, offsets:List,
+                        labels:np.ndarray, scores:np.ndarray):
+        """
+        join the token level predictions for a text into entities with array
+        operations. Every token of a word takes the label of the word's first
+        token, an entity is a run of tokens of one type starting at a B- label
+        or after a token of another type, [SEP]s are never part of one.
+        :param text: the text as tokenized
+        :param input_ids: token ids of the text, without special tokens
+        :param word_ids: word index of each token
+        :param offsets: (start, end) char offsets of the tokens in text
+        :param labels: label index predicted for each token
+        :param scores: score of each token's label
+        :return: entities sliced from text, types, mean token scores, char
+        offsets of the entities in text
+        """
+        n = len(input_ids)
+        if n == 0:
+            return [], [], [], []
+        words = np.array(word_ids, dtype=float)  # None -> nan, a word of its own
+        word_start = np.ones(n, dtype=bool)
+        word_start[1:] = words[1:] != words[:-1]
+        first_token = np.maximum.accumulate(np.where(word_start, np.arange(n), 0))
+        labels = np.asarray(labels)[first_token]
+        types = self._label_types[labels]
+        types[np.asarray(input_ids) == self.tokenizer.sep_token_id] = -1
+        in_entity = types >= 0
+
+        previous_types = np.concatenate(([-1], types[:-1]))
+        starts = in_entity & ((types != previous_types) | (self._label_begins[labels] & word_start))
+        if not starts.any():
+            return [], [], [], []
+        ends = in_entity & ~np.concatenate((in_entity[1:] & ~starts[1:], [False]))
+        span = np.cumsum(starts)[in_entity] - 1
+        mean_scores = (np.bincount(span, weights=np.asarray(scores)[in_entity]) / np.bincount(span)).tolist()
+
+        entity_offsets = [offsets[first][0] for first in np.flatnonzero(starts)]
+        entities = [text[offset:offsets[last][1]] for offset, last in zip(entity_offsets, np.flatnonzero(ends))]
+        entity_types = [self.entity_types[t] for t in types[starts]]
+        return entities, entity_types, mean_scores, entity_offsets
+
+    def signature(self, fingerprint:str=None) -> str:
+        """
+        :param fingerprint: str identifying the model files, default their
+        ner_cache.model_fingerprint, so a model retrained in place changes
+        the signature
+        :return: str identifying the model and settings NER results depend on
+        """
+        if fingerprint is None:
+            if self._fingerprint is None:
+                self._fingerprint = model_fingerprint(self.model_path)
+            fingerprint = self._fingerprint
+        signature = f'{self.model_path}:{fingerprint}:{self.backend_name}:dedup={self.dedup_segments}:stride={self.stride}'
+        if self.gate:
+            signature += ':gate'
+        return signature
+
+    def _token_windows(self, input_ids:List, word_ids:List) -> List:
+        """
+        pack a tokenized text into windows of at most self.max_tokens tokens.
+        Windows end after a [SEP] (field boundary) where possible, otherwise at
+        a word boundary, and overlap the next window by about self.stride
+        tokens. Each token is owned by exactly one window: overlaps are split
+        at a word boundary near their middle.
+        :param input_ids: token ids of the text, without special tokens
+        :param word_ids: word index of each token
+        :return: list of (start, end, owned start, owned end) token indexes
+        """
+        n = len(input_ids)
+        sep_id = self.tokenizer.sep_token_id
+
+        def word_start(i):
+            return i == 0 or i >= n or word_ids[i] != word_ids[i-1]
+
+        windows = []
+        start = 0
+        while start < n:
+            end = start + self.max_tokens
+            if end >= n:
+                end = n
             else:
-                a=rec['word']
-                s+=rec['score']
-                if a[0]=='#':
-                    a=a[2:]
-                    tmp+=a
-                    # print(f'# add tmp: {tmp}')
-                else:
-                    tmp+=' '
-                    tmp+=a
-                counter+=1
-            if word_count == len(ner_res)-1:
-                # print(f'final tmp: {tmp}')           
-                output.append(tmp)
-                scores.append(s/counter)
-                types.append(t)
-                tmp=rec['word']
-                s=rec['score']
-                if rec['entity']=='B-ORG':
-                    t='Organization'
-                if rec['entity']=='B-PER':
-                    t='Person'
-                if rec['entity']=='B-LOC':
-                    t='Location'
-                if rec['entity']=='B-MISC':
-                    t='Miscellaneous'
-
-        return(output,types,scores, self.get_tokens(txt))
+                # cut in the back half of the window, on a field boundary if there is one
+                lowest = start + self.max_tokens//2
+                cut = next((b for b in range(end, lowest, -1) if input_ids[b-1] == sep_id), None)
+                if cut is None:
+                    cut = next((b for b in range(end, lowest, -1) if word_start(b)), end)
+                end = cut
+            windows.append((start, end))
+            if end == n:
+                break
+            next_start = end - self.stride
+            while next_start > start + 1 and not word_start(next_start):
+                next_start -= 1
+            start = next_start
+
+        owned_bounds = [0]
+        for (_, end), (next_start, _) in zip(windows, windows[1:]):
+            middle = (next_start + end)//2
+            while middle > next_start and not word_start(middle):
+                middle -= 1
+            owned_bounds.append(middle)
+        owned_bounds.append(n)
+        return [(start, end, owned_bounds[k], owned_bounds[k+1]) for k, (start, end) in enumerate(windows)]
 
     @staticmethod
-    def _chunk_out_text(text:str, chunk_size:int = 512) -> List:
+    def _normalize_segment(segment:str) -> str:
+        return ' '.join(segment.split()).casefold()
+
+    def _dedup_segments(self, text:str, separator:str='|'):
         """
-        :param text: any string
-        :param chunk_size: any positive int
-        split up test a list of 0-to-n chunk_size strings and one string with the remaining <chunk_size chunk
+        drop exact and normalized (whitespace and case insensitive) duplicates
+        of the |-separated segments of text, keeping the first occurrence.
+        :param text: |-separated incident text
+        :param separator: what the kept segments are joined with
+        :return: (text of the unique segments joined by separator, [(start,
+        end, number of occurrences)] char spans in it of the kept segments
+        that occurred more than once)
         """
-        i = 0
-        chunks = []
-        while i < len(text):
-            if i+chunk_size < len(text):
-                chunks.append(text[i:i+chunk_size])
+        segments = re.split(r"[|]+", text)
+        counts = {}
+        kept = []
+        for segment in segments:
+            key = self._normalize_segment(segment)
+            if key in counts:
+                counts[key] += 1
             else:
-                chunks.append(text[i:len(text)])
-            i += chunk_size
-        return chunks
+                counts[key] = 1
+                kept.append((key, segment))
+        repeated = {key: n for key, n in counts.items() if n > 1 and key}
+        self.dedup_stats['segments'] += len(segments)
+        self.dedup_stats['duplicate segments'] += len(segments) - len(kept)
+        if repeated:
+            # BERT tokens that would have been run through NER for the dropped copies
+            lengths = self.tokenizer(list(repeated), add_special_tokens=False)['input_ids']
+            self.dedup_stats['duplicate tokens'] += sum((repeated[key]-1)*len(ids)
+                                                        for key, ids in zip(repeated, lengths))
+        back_references = []
+        start = 0
+        for key, segment in kept:
+            if key in repeated:
+                back_references.append((start, start + len(segment), repeated[key]))
+            start += len(segment) + len(separator)
+        return separator.join(segment for _, segment in kept), back_references
+
+    @staticmethod
+    def _restore_duplicates(entities:List, types:List, scores:List, offsets:List, back_references:List):
+        """
+        repeat each entity found in a collapsed segment once per dropped copy of
+        the segment, so per incident entity counts match the full text.
+        :param offsets: char offset of each entity in the deduplicated text
+        :param back_references: (start, end, number of occurrences) char spans
+        of the repeated segments, in text order
+        :return: entities, types, scores with duplicates restored
+        """
+        if not back_references:
+            return entities, types, scores
+        span_starts = [start for start, _, _ in back_references]
+        out_entities, out_types, out_scores = [], [], []
+        for entity, entity_type, score, offset in zip(entities, types, scores, offsets):
+            copies = 1
+            k = bisect.bisect_right(span_starts, offset) - 1
+            if k >= 0 and offset < back_references[k][1]:
+                copies = back_references[k][2]
+            out_entities.extend([entity]*copies)
+            out_types.extend([entity_type]*copies)
+            out_scores.extend([score]*copies)
+        return out_entities, out_types, out_scores
+
+    def _may_contain_entities(self, words:List, input_ids:List, start:int, end:int) -> bool:
+        """
+        cheap rule based gate run before the model: the cased model finds
+        entities in capitalized words, so a window of only separators,
+        numbers, dates, flags or lower case text is not worth a forward pass.
+        :param words: token strings of the text
+        :param input_ids: token ids of the text
+        :return: True if tokens start to end, [SEP]s aside, include a token
+        starting with a capital letter and at least GATE_MIN_LETTERS letters
+        """
+        sep_id = self.tokenizer.sep_token_id
+        letters = 0
+        capitalized = False
+        for k in range(start, end):
+            if input_ids[k] == sep_id:
+                continue
+            word = words[k]
+            letters += sum(c.isalpha() for c in word)
+            capitalized = capitalized or word[0].isupper()
+            if capitalized and letters >= GATE_MIN_LETTERS:
+                return True
+        return False
+
+    def _check_gate(self, checks:List, batch_size:int):
+        """
+        run the model over a sample of the windows the gate skipped and count
+        those it would have found entities in
+        :param checks: list of (window, window input ids)
+        """
+        predictions = self._predict([window_input for _, window_input in checks], batch_size)
+        for ((start, _, owned_start, owned_end), _), (labels, _) in zip(checks, predictions):
+            self.gate_stats['checked windows'] += 1
+            # predictions are offset by one for the window's leading [CLS]
+            owned_labels = labels[owned_start - start + 1:owned_end - start + 1]
+            if (self._label_types[owned_labels] >= 0).any():
+                self.gate_stats['checked windows with entities'] += 1
 
     def ner_over_chunks(self, actual_text:str) -> List:
         """
-        Take a string of any length, cut it into 512 char sections, run NER on each section then reassemble the
-        results into one list.
+        Take a string of any length, cut it into token windows the size of
+        the model's maximum sequence length, run NER on each window then
+        reassemble the results into one list.
         :param actual_text: any string - here all concatenated text associated with an incident_id_column_name
         :return: List of three lists [[entities], [entity types], [scores]]
         """
-        actual_text = re.sub(r"[|]+", self.tokenizer.sep_token, actual_text)  # aggregated source text is separated by |'s.
-        chunks = self._chunk_out_text(actual_text)
-        aggregated_results = [[],[],[],[]]
-        chunk_ners = []
-        for c in chunks:
-            # NERPipeline returns 3 value list
-            # chunk_ners is a list of three value lists
-            res = self.nerfunc(c)
-            chunk_ners.append(res)
-        
-        for c in chunk_ners:
-            for j in range(4):
-                aggregated_results[j].extend(c[j]) 
-
-        entities = aggregated_results[0]
-        types = aggregated_results[1]
-        scores = aggregated_results[2]
-        tokens = aggregated_results[3]
-        
-        self._store_entities(entities)
-        
-        self._store_tokens(tokens)
-        
-        return entities, types, scores
+        return self.ner_over_texts([actual_text], batch_size=1)[0]
+
+    def ner_over_texts(self, texts:List, batch_size:int=None) -> List:
+        """
+        ner_over_chunks for many texts at once: the token windows of all
+        texts are run through the model together, batch_size windows per
+        forward pass, and the entities are reassembled per text in order.
+        Texts are tokenized once, the windows are run through the model as
+        token ids. Token level results in the overlap of two windows are only
+        kept from the window owning the token, so entities are neither
+        duplicated nor cut at window edges. With self.gate windows failing
+        _may_contain_entities are not run through the model.
+        :param texts: list of strings - here the concatenated text of many incidents
+        :param batch_size: windows per forward pass, default self.batch_size
+        :return: list of [[entities], [entity types], [scores]], one per text
+        """
+        if not texts:
+            return []
+        batch_size = batch_size or self.batch_size
+        back_references = []
+        prepared_texts = []
+        for actual_text in texts:
+            references = []
+            if self.dedup_segments:
+                actual_text, references = self._dedup_segments(actual_text, self.tokenizer.sep_token)
+            back_references.append(references)
+            prepared_texts.append(re.sub(r"[|]+", self.tokenizer.sep_token, actual_text))  # aggregated source text is separated by |'s.
+
+        # one encoding per text gives the windows' token ids, the offsets
+        # entities are sliced from the text at and the token statistics
+        windows = []  # (text index, start, end, owned start, owned end)
+        window_inputs = []
+        gate_checks = []  # skipped windows to check, (window, window input)
+        tokens = [[] for _ in texts]
+        encodings = self.tokenizer(prepared_texts, add_special_tokens=False, return_offsets_mapping=True)
+        for i in range(len(prepared_texts)):
+            input_ids = encodings['input_ids'][i]
+            words = encodings.tokens(i) if self.gate else None
+            for window in self._token_windows(input_ids, encodings.word_ids(i)):
+                start, end = window[:2]
+                window_input = [self.tokenizer.cls_token_id] + input_ids[start:end] + [self.tokenizer.sep_token_id]
+                tokens[i].extend(window_input)
+                if self.gate:
+                    self.gate_stats['windows'] += 1
+                    if not self._may_contain_entities(words, input_ids, start, end):
+                        self.gate_stats['skipped windows'] += 1
+                        self.gate_stats['skipped tokens'] += len(window_input)
+                        if self.gate_check_every and (self.gate_stats['skipped windows'] - 1) % self.gate_check_every == 0:
+                            gate_checks.append((window, window_input))
+                        continue
+                windows.append((i,) + window)
+                window_inputs.append(window_input)
+
+        predictions = self._cached_predict(window_inputs, batch_size)
+        if gate_checks:
+            self._check_gate(gate_checks, batch_size)
+
+        # keep each window's predictions only for the tokens it owns, windows
+        # the gate skipped are left 'O'
+        text_labels = [np.full(len(ids), self._o_label) for ids in encodings['input_ids']]
+        text_scores = [np.zeros(len(ids), dtype=np.float32) for ids in encodings['input_ids']]
+        for (i, start, end, owned_start, owned_end), (labels, scores) in zip(windows, predictions):
+            # predictions are offset by one for the window's leading [CLS]
+            text_labels[i][owned_start:owned_end] = labels[owned_start - start + 1:owned_end - start + 1]
+            text_scores[i][owned_start:owned_end] = scores[owned_start - start + 1:owned_end - start + 1]
+
+        results = []
+        for i, (text_tokens, references) in enumerate(zip(tokens, back_references)):
+            entities, types, scores, offsets = self.decode_entities(prepared_texts[i], encodings['input_ids'][i], encodings.word_ids(i),
+                                                                    encodings['offset_mapping'][i], text_labels[i], text_scores[i])
+            entities, types, scores = self._restore_duplicates(entities, types, scores, offsets, references)
+            self._store_entities(entities)
+            self._store_tokens(text_tokens)
+            results.append((entities, types, scores))
+        return results
+    
+    @staticmethod
+    def _work_units(texts:List, units:int) -> List:
+        """
+        split texts into about units runs of consecutive texts with similar
+        total length
+        :return: list of (index of the first text, list of texts)
+        """
+        target = max(1, sum(len(t) for t in texts)//units)
+        work_units = []
+        first = 0
+        size = 0
+        for i, text in enumerate(texts):
+            size += len(text)
+            if size >= target:
+                work_units.append((first, texts[first:i+1]))
+                first = i + 1
+                size = 0
+        if first < len(texts):
+            work_units.append((first, texts[first:]))
+        return work_units
+
+    def ner_over_unit(self, texts:List) -> Tuple:
+        """
+        ner_over_texts for a unit of work whose results and statistics are
+        merged into another NERPipeline, e.g. in a forked worker or on another
+        host, see merge_unit_stats
+        :param texts: list of strings
+        :return: results, the unit's TokenStatistics, tokens per text if kept,
+        and the dedup, gate, padding and cache statistics the unit added
+        """
+        self.tokens = []
+        self.entities = []
+        self.token_stats = TokenStatistics(self.vocab_size)
+        dedup_before = dict(self.dedup_stats)
+        gate_before = dict(self.gate_stats)
+        padding_before = dict(self.padding_stats)
+        cache_before = (self.cache.hits, self.cache.misses, self.cache.evictions) if self.cache else (0, 0, 0)
+        results = self.ner_over_texts(texts)
+        dedup = {k: v - dedup_before[k] for k, v in self.dedup_stats.items()}
+        gate = {k: v - gate_before[k] for k, v in self.gate_stats.items()}
+        padding = {k: v - padding_before[k] for k, v in self.padding_stats.items()}
+        cache_after = (self.cache.hits, self.cache.misses, self.cache.evictions) if self.cache else (0, 0, 0)
+        return results, self.token_stats, self.tokens, dedup, gate, padding, [b - a for a, b in zip(cache_before, cache_after)]
+
+    def merge_unit_stats(self, token_stats:TokenStatistics, dedup:Dict, gate:Dict, padding:Dict, cache:List):
+        """
+        add the statistics of a unit run by ner_over_unit to this pipeline's
+        """
+        self.token_stats.merge(token_stats)
+        for k, v in dedup.items():
+            self.dedup_stats[k] += v
+        for k, v in gate.items():
+            self.gate_stats[k] += v
+        for k, v in padding.items():
+            self.padding_stats[k] += v
+        if self.cache:
+            self.cache.hits += cache[0]
+            self.cache.misses += cache[1]
+            self.cache.evictions += cache[2]
+
+    def ner_over_texts_parallel(self, texts:List, workers:int, progress=None) -> List:
+        """
+        ner_over_texts in a pool of forked worker processes. The workers share
+        this process's loaded model copy-on-write and each get an equal share
+        of the cores for their forward passes. Texts are sent out in units of
+        similar total length and the results put back in text order, so the
+        output is the same however the units finish.
+        :param texts: list of strings - here the concatenated text of many incidents
+        :param workers: number of worker processes
+        :param progress: optional callable, called with the number of texts
+        in each finished unit
+        :return: list of [[entities], [entity types], [scores]], one per text
+        """
+        global _worker_pipeline
+        threads = max(1, (os.cpu_count() or 1)//workers)
+        results = [None]*len(texts)
+        tokens = [None]*len(texts)
+        # load the model before forking so the workers share it
+        self._load()
+        _worker_pipeline = self
+        try:
+            with multiprocessing.get_context('fork').Pool(workers, initializer=_init_ner_worker,
+                                                          initargs=(threads,)) as pool:
+                for first, unit_results, unit_stats, unit_tokens, dedup, gate, padding, cache in pool.imap_unordered(
+                        _ner_work_unit, self._work_units(texts, 8*workers)):
+                    results[first:first+len(unit_results)] = unit_results
+                    tokens[first:first+len(unit_tokens)] = unit_tokens
+                    self.merge_unit_stats(unit_stats, dedup, gate, padding, cache)
+                    if progress:
+                        progress(len(unit_results))
+        finally:
+            _worker_pipeline = None
+
+        if self.keep_tokens:
+            self.tokens.extend(tokens)
+            self.entities.extend(entities for entities, _, _ in results)
+        return results
     
 if __name__=="__main__":
-    np = NERPipeline()
+    nerp = NERPipeline(keep_tokens=True)
     texts = [
         "Bucky's a badger. that lives in Madison, WI| Bubbles is a clown"
         ]
     for txt in texts:
-        output,types,scores=np.ner_over_chunks(txt)
+        output,types,scores=nerp.ner_over_chunks(txt)
         print(f'output: {output}')
         print(f'types: {types}')
         print(f'scores: {scores}')
-        print(f'bert tokens: {np.tokens}')
-        print(f'tokens: {np.get_decoded_tokens()}')
-        print(f'token_stats: {np.get_token_stats()}')
-        print(f'entities: {np.entities}')
+        print(f'bert tokens: {nerp.tokens}')
+        print(f'tokens: {nerp.get_decoded_tokens()}')
+        print(f'token_stats: {nerp.get_token_stats()}')
+        print(f'entities: {nerp.entities}')
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Reporting periods compiled to date intervals.
+
+Every APOLLO period ('week', 'trailing_seven_days', 'month') is a contiguous
+run of days, so checking whether an EpisodeDate falls in a period only needs
+two comparisons against the period's first and last day. ISO formatted dates
+sort the same as strings as they do as dates, so well formed values are
+compared as strings without being parsed.
+"""
+from datetime import datetime, date, timedelta
+import calendar
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PERIODS = ['week', 'month', 'all', 'trailing_seven_days']
+
+# date keys for values with no usable date
+EMPTY_DATE = 0
+INVALID_DATE = -1
+
+
+def parse_date(value: str) -> date:
+    """
+    :param value: plain text date in format "YYYY-MM-DD <stuff>"
+    :return: date
+    :raises ValueError: if the date can't be parsed
+    """
+    return datetime.strptime(value.split(" ")[0], '%Y-%m-%d').date()
+
+
+def date_key(value: str) -> int:
+    """
+    convert a WEDSS date to a sortable YYYYMMDD int
+    :param value: plain text date in format "YYYY-MM-DD <stuff>"
+    :return: YYYYMMDD int, EMPTY_DATE for '' or INVALID_DATE if it can't be parsed
+    """
+    if value == '':
+        return EMPTY_DATE
+    try:
+        d = parse_date(value)
+    except ValueError:
+        return INVALID_DATE
+    return d.year * 10000 + d.month * 100 + d.day
+
+
+def _is_iso_shaped(value: str) -> bool:
+    """True if value starts with a zero padded YYYY-MM-DD followed by nothing or a space"""
+    return len(value) >= 10 \
+        and value[4] == '-' and value[7] == '-' \
+        and value[:4].isdigit() and value[5:7].isdigit() and value[8:10].isdigit() \
+        and (len(value) == 10 or value[10] == ' ')
+
+
+class DatePeriod:
+    """
+    a reporting period around a given day.
+
+    attributes:
+    period: 'week', 'trailing_seven_days', 'month' or 'all'
+    dates: list of every date in the period (in the order ApolloDetector has
+    always reported them), or 'all'
+    start, end: first and last date of the period, None for 'all'
+    start_key, end_key: start and end as YYYYMMDD ints
+    """
+    def __init__(self, day: str, period: str):
+        """
+        :param day: string in format "YYYY-MM-DD" or "YYYY-MM-DD <anything_else>"
+        :param period: string specifying the days in the period:
+                        'week': all the dates in the calendar week for param day
+                        'trailing_seven_days': the six days leading up to 'day' plus that day.
+                        'month': all the days in the month of 'day'
+                        'all': every date.
+        :raises ValueError: for an unknown period or a day that can't be parsed
+        """
+        if period not in PERIODS:
+            raise ValueError("period type must be 'week', 'month', trailing_seven_days' or 'all'")
+        self.period = period
+        if period == 'all':
+            self.dates = 'all'
+            self.start = self.end = None
+            return
+
+        d = parse_date(day)
+        if period == 'week':
+            day_of_week = d.isocalendar()[2]-1
+            start_date = d - timedelta(days=day_of_week)
+            self.dates = [start_date + timedelta(days=i) for i in range(7)]
+        if period == 'trailing_seven_days':
+            self.dates = [d - timedelta(days=i) for i in range(7)]
+        if period == 'month':
+            number_of_days = calendar.monthrange(d.year, d.month)[1]
+            self.dates = [date(d.year, d.month, day) for day in range(1, number_of_days+1)]
+
+        self.start = min(self.dates)
+        self.end = max(self.dates)
+        self.start_iso = self.start.isoformat()
+        self.end_iso = self.end.isoformat()
+        self.start_key = int(self.start.strftime('%Y%m%d'))
+        self.end_key = int(self.end.strftime('%Y%m%d'))
+
+    def __repr__(self):
+        if self.period == 'all':
+            return "DatePeriod('all')"
+        return f"DatePeriod('{self.period}', {self.start_iso} to {self.end_iso})"
+
+    def contains(self, value: str) -> bool:
+        """
+        :param value: plain text date in format "YYYY-MM-DD <stuff>"
+        :return: True if the date is in the period, else False. Always True
+        for 'all'. False if the date can't be parsed.
+        """
+        if self.dates == 'all':
+            return True
+        if _is_iso_shaped(value):
+            # cheap reject for the vast majority of rows, parse only what's left
+            if not (self.start_iso <= value[:10] <= self.end_iso):
+                return False
+        try:
+            d = parse_date(value)
+        except ValueError:
+            logger.warning(f"not a valid date value: {value}")
+            return False
+        return self.start <= d <= self.end
+
+    __contains__ = contains
+
+    def mask(self, date_keys: np.ndarray) -> np.ndarray:
+        """
+        batch form of contains for dates already converted with date_key
+        :param date_keys: array of YYYYMMDD ints, EMPTY_DATE or INVALID_DATE
+        :return: boolean array, True for dates in the period. For 'all', every
+        non empty date.
+        """
+        date_keys = np.asarray(date_keys)
+        if self.dates == 'all':
+            return date_keys != EMPTY_DATE
+        return (date_keys >= self.start_key) & (date_keys <= self.end_key)
@@ -0,0 +1,505 @@
+# -*- coding: utf-8 -*-
+"""
+Sharded NER over a shared directory, run by any number of processes on any
+number of hosts.
+
+An ApolloDetector run with --distributed_dir is the coordinator: it shards
+the incidents to run through NER into work units by a hash of their
+incidentID and writes the units to a run directory under the shared
+directory. Workers, started on any host that mounts the directory, from the
+NER directory and with the same model, by
+
+    python APOLLO/distributed_ner.py --work_dir /shared/apollo_ner
+
+claim a unit by creating its lock file, which only one process can create,
+run NER over it and write the unit's results next to it. The coordinator
+works on units too, so a run finishes without any workers, then merges the
+partial results in incident order, the same results as a single process.
+
+While a unit runs its lock file's mtime is kept current. A lock left
+unchanged for stale_seconds, e.g. by a worker that crashed or whose host went
+down, is broken and the unit claimed again. A unit whose NER raises is
+released and retried, by any process, until it has failed max_attempts
+times, then the coordinator stops the run with WorkUnitFailedError. Every file is written to a
+temporary name and renamed into place, so no process reads a half written
+file. No scheduler is needed, only a filesystem with atomic exclusive create
+and rename, e.g. NFS v3 or later.
+"""
+from pathlib import Path
+from typing import List, Dict, Callable
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import socket
+import threading
+import time
+import uuid
+
+import click
+
+from NERPipeline import NERPipeline
+
+logger = logging.getLogger(__name__)
+
+QUEUE_VERSION = 2
+STALE_SECONDS = 600
+POLL_SECONDS = 5
+MAX_ATTEMPTS = 3
+
+# NERPipeline per settings and NER cache in this process, see get_pipeline
+_pipelines = {}
+_model_hashes = {}  # model path -> model_hash
+
+
+class WorkUnitFailedError(Exception):
+    pass
+
+
+def shard_of(incident_id:str, units:int) -> int:
+    """
+    :return: the work unit incident_id belongs to, the same on every host and run
+    """
+    return int(hashlib.sha1(str(incident_id).encode('utf-8')).hexdigest(), 16) % units
+
+
+def pipeline_settings(nlp:NERPipeline) -> Dict:
+    """
+    :return: the NERPipeline arguments NER results depend on, for workers to
+    build the same pipeline with
+    """
+    return {'model_path': nlp.model_path, 'backend': nlp.backend_name,
+            'dedup_segments': nlp.dedup_segments, 'batch_size': nlp.batch_size,
+            'stride': nlp.stride, 'gate': nlp.gate, 'gate_check_every': nlp.gate_check_every}
+
+
+def get_pipeline(settings:Dict, cache_path:str=None, cache_max_mb:int=1024) -> NERPipeline:
+    """
+    :param settings: pipeline_settings
+    :param cache_path: optional SQLite NER cache on this host, see NERChunkCache
+    :return: a NERPipeline built with settings, one per settings and cache in a process
+    """
+    key = json.dumps([settings, str(cache_path) if cache_path else None, cache_max_mb], sort_keys=True)
+    if key not in _pipelines:
+        _pipelines[key] = NERPipeline(cache_path=cache_path, cache_max_mb=cache_max_mb, **settings)
+    return _pipelines[key]
+
+
+def model_hash(model_path:str) -> str:
+    """
+    :return: hash of the name and contents of every file in model_path, the
+    same on every host with the same model files, whatever their mtimes
+    """
+    if model_path not in _model_hashes:
+        files = hashlib.sha1()
+        for path in sorted(Path(model_path).rglob('*')):
+            if path.is_file():
+                files.update(str(path.relative_to(model_path)).encode('utf-8'))
+                with path.open('rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        files.update(block)
+        _model_hashes[model_path] = files.hexdigest()
+    return _model_hashes[model_path]
+
+
+def run_signature(nlp:NERPipeline) -> str:
+    """
+    :return: nlp.signature() with the model_hash of its model files, which
+    unlike their mtimes are the same on every host, a worker only runs units
+    of runs with its own run_signature
+    """
+    return nlp.signature(fingerprint=model_hash(nlp.model_path))
+
+
+def _write_atomic(path:Path, data:bytes):
+    tmp_path = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+    with tmp_path.open('wb') as f:
+        f.write(data)
+    tmp_path.replace(path)
+
+
+class WorkQueue:
+    """
+    the work units of one run in a directory shared by the coordinator and
+    workers: manifest.json, then per unit NNNNN.unit with the (incidentID,
+    text) pairs, NNNNN.lock while a process works on it, NNNNN.result
+    once it is done and NNNNN.failed counting its failed attempts
+
+    attributes:
+    run_dir: directory of the run
+    stale_seconds: age of a lock's mtime after which it is broken
+    manifest: {'version', 'units': [unit names], 'settings': NERPipeline
+    arguments, 'signature': the coordinator's run_signature, 'max_attempts':
+    failed attempts after which a unit isn't claimed again}
+    """
+    def __init__(self, run_dir:Path, stale_seconds:int=STALE_SECONDS):
+        self.run_dir = Path(run_dir)
+        self.stale_seconds = stale_seconds
+        with (self.run_dir / 'manifest.json').open('r') as f:
+            self.manifest = json.load(f)
+
+    @classmethod
+    def create(cls, work_dir:Path, texts:Dict, units:int, nlp:NERPipeline,
+               stale_seconds:int=STALE_SECONDS, max_attempts:int=MAX_ATTEMPTS) -> 'WorkQueue':
+        """
+        shard texts into at most units work units in a new run directory under
+        work_dir. The manifest is written last: workers only pick up a run
+        once all its units are there.
+        :param texts: {incidentID: text}
+        :param nlp: NERPipeline whose settings the workers use
+        :param max_attempts: failed attempts after which a unit isn't claimed again
+        """
+        run_dir = Path(work_dir) / f'run-{time.strftime("%Y%m%d%H%M%S")}-{socket.gethostname()}-{os.getpid()}'
+        run_dir.mkdir(parents=True)
+        shards = {}
+        for incident_id, text in texts.items():
+            shards.setdefault(shard_of(incident_id, units), []).append((incident_id, text))
+        names = []
+        for shard in sorted(shards):
+            name = f'{shard:05d}'
+            _write_atomic(run_dir / f'{name}.unit', pickle.dumps(shards[shard], protocol=pickle.HIGHEST_PROTOCOL))
+            names.append(name)
+        manifest = {'version': QUEUE_VERSION, 'units': names,
+                    'settings': pipeline_settings(nlp), 'signature': run_signature(nlp),
+                    'max_attempts': max_attempts}
+        _write_atomic(run_dir / 'manifest.json', json.dumps(manifest).encode('utf-8'))
+        logger.info(f'wrote {len(texts)} incidents in {len(names)} NER work units to {run_dir}')
+        return cls(run_dir, stale_seconds)
+
+    @property
+    def units(self) -> List:
+        return self.manifest['units']
+
+    def is_finished(self) -> bool:
+        """
+        :return: True once the coordinator has merged the run's results
+        """
+        return (self.run_dir / 'finished').exists()
+
+    def has_result(self, unit:str) -> bool:
+        return (self.run_dir / f'{unit}.result').exists()
+
+    def claim(self, unit:str) -> bool:
+        """
+        create unit's lock file, breaking a stale lock first
+        :return: True if this process now holds the lock
+        """
+        lock_path = self.run_dir / f'{unit}.lock'
+        for _ in range(2):
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._break_stale_lock(lock_path):
+                    return False
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(f'{socket.gethostname()} {os.getpid()}\n')
+            return True
+        return False
+
+    def failures(self, unit:str) -> Dict:
+        """
+        :return: {'attempts': failed attempts, 'error': where and how the last
+        one failed}, or None if unit hasn't failed
+        """
+        try:
+            with (self.run_dir / f'{unit}.failed').open('r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def has_failed(self, unit:str) -> bool:
+        """
+        :return: True once unit has failed max_attempts times
+        """
+        failures = self.failures(unit)
+        return failures is not None and failures['attempts'] >= self.manifest['max_attempts']
+
+    def record_failure(self, unit:str, error:str) -> int:
+        """
+        count a failed attempt at unit, by the process holding its lock
+        :return: number of failed attempts
+        """
+        failures = self.failures(unit) or {'attempts': 0}
+        failures = {'attempts': failures['attempts'] + 1, 'error': error}
+        _write_atomic(self.run_dir / f'{unit}.failed', json.dumps(failures).encode('utf-8'))
+        return failures['attempts']
+
+    def claim_pending(self, unit:str) -> bool:
+        """
+        claim unit if it has no result yet and hasn't failed max_attempts times
+        :return: True if this process now holds the lock of a unit still to run
+        """
+        if self.has_result(unit) or self.has_failed(unit) or not self.claim(unit):
+            return False
+        # another process may have written the result and released the lock
+        # between has_result and claim
+        if self.has_result(unit):
+            self.release(unit)
+            return False
+        return True
+
+    def _break_stale_lock(self, lock_path:Path) -> bool:
+        """
+        :return: True if lock_path was stale and this process removed it
+        """
+        try:
+            age = time.time() - lock_path.stat().st_mtime
+        except FileNotFoundError:
+            return True
+        if age < self.stale_seconds:
+            return False
+        # only one of several processes breaking the same lock wins the rename
+        broken_path = lock_path.with_name(f'{lock_path.name}.{uuid.uuid4().hex}.stale')
+        try:
+            lock_path.rename(broken_path)
+        except FileNotFoundError:
+            return False
+        owner = broken_path.read_text().strip()
+        broken_path.unlink()
+        logger.warning(f'broke NER work unit lock {lock_path} held by {owner}, unchanged for {age:.0f}s')
+        return True
+
+    def heartbeat(self, unit:str):
+        """
+        keep unit's lock from going stale
+        """
+        try:
+            os.utime(self.run_dir / f'{unit}.lock')
+        except FileNotFoundError:
+            pass
+
+    def release(self, unit:str):
+        try:
+            (self.run_dir / f'{unit}.lock').unlink()
+        except FileNotFoundError:
+            pass
+
+    def read_unit(self, unit:str) -> List:
+        """
+        :return: list of (incidentID, text)
+        """
+        with (self.run_dir / f'{unit}.unit').open('rb') as f:
+            return pickle.load(f)
+
+    def write_result(self, unit:str, result:Dict):
+        _write_atomic(self.run_dir / f'{unit}.result', pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def read_result(self, unit:str) -> Dict:
+        """
+        :return: {'results': {incidentID: result}, 'stats': statistics for
+        NERPipeline.merge_unit_stats, 'host', 'seconds'}, or None if unit
+        isn't done
+        """
+        try:
+            with (self.run_dir / f'{unit}.result').open('rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def holders(self) -> Dict:
+        """
+        :return: {unit: lock file contents} of units being worked on
+        """
+        holders = {}
+        for lock_path in self.run_dir.glob('*.lock'):
+            try:
+                holders[lock_path.stem] = lock_path.read_text().strip()
+            except FileNotFoundError:
+                pass
+        return holders
+
+    def finish(self, keep:bool=False):
+        """
+        mark the run finished, so workers skip it, and remove it unless keep
+        """
+        _write_atomic(self.run_dir / 'finished', b'')
+        if not keep:
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+
+
+class _Heartbeat:
+    """
+    context manager touching a unit's lock every stale_seconds/4 in a thread
+    """
+    def __init__(self, queue:WorkQueue, unit:str):
+        self.queue = queue
+        self.unit = unit
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+
+    def _beat(self):
+        while not self._stop.wait(max(1, self.queue.stale_seconds/4)):
+            self.queue.heartbeat(self.unit)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_unit(queue:WorkQueue, unit:str, nlp:NERPipeline):
+    """
+    run NER over a claimed unit, write its result, or count a failed
+    attempt if NER raises, and release its lock
+    :param nlp: NERPipeline built with the run's settings
+    """
+    try:
+        with _Heartbeat(queue, unit):
+            start = time.perf_counter()
+            pairs = queue.read_unit(unit)
+            results, token_stats, _, dedup, gate, padding, cache = nlp.ner_over_unit([text for _, text in pairs])
+            queue.write_result(unit, {'results': dict(zip((incident_id for incident_id, _ in pairs), results)),
+                                      'stats': (token_stats, dedup, gate, padding, cache),
+                                      'host': socket.gethostname(),
+                                      'seconds': time.perf_counter() - start})
+        logger.info(f'ran NER over work unit {unit} of {queue.run_dir.name}, {len(pairs)} incidents in {time.perf_counter() - start:.1f}s')
+    except Exception as e:
+        attempts = queue.record_failure(unit, f'{socket.gethostname()} {os.getpid()}: {e!r}')
+        logger.exception(f'NER over work unit {unit} of {queue.run_dir.name} failed, '
+                         f'attempt {attempts} of {queue.manifest["max_attempts"]}')
+    finally:
+        queue.release(unit)
+
+
+def work_on(queue:WorkQueue, nlp:NERPipeline) -> int:
+    """
+    claim and run every unit of queue that is not done, failed or held by another process
+    :param nlp: NERPipeline built with the run's settings
+    :return: number of units run
+    """
+    count = 0
+    for unit in queue.units:
+        if queue.is_finished():
+            break
+        if queue.claim_pending(unit):
+            run_unit(queue, unit, nlp)
+            count += 1
+    return count
+
+
+def ner_over_texts_distributed(nlp:NERPipeline, texts:Dict, work_dir:Path, units:int=64,
+                               stale_seconds:int=STALE_SECONDS, poll_seconds:float=POLL_SECONDS,
+                               progress:Callable=None, max_attempts:int=MAX_ATTEMPTS) -> Dict:
+    """
+    coordinate a distributed NER run: shard texts into a WorkQueue under
+    work_dir, work on units alongside any workers, break the locks of units
+    whose worker stopped, and merge the results and their statistics into nlp
+    :param nlp: NERPipeline whose settings the run uses and whose statistics
+    the units' are merged into
+    :param texts: {incidentID: text}
+    :param work_dir: directory shared with the workers
+    :param units: number of shards, several per worker so faster hosts take more
+    :param stale_seconds: age of a lock's mtime after which its unit is claimed again
+    :param poll_seconds: time between checks for units finished by workers
+    :param progress: optional callable, called with the number of incidents
+    in each merged unit
+    :param max_attempts: failed attempts at a unit after which the run stops
+    :return: {incidentID: [[entities], [entity types], [scores]]} in texts order
+    :raises WorkUnitFailedError: if a unit failed max_attempts times, the
+    run's files are kept for inspection
+    """
+    queue = WorkQueue.create(work_dir, texts, units, nlp, stale_seconds, max_attempts)
+    # units run here go through their own pipeline like a worker's, sharing
+    # nlp's NER cache, only merged statistics reach nlp
+    local = get_pipeline(queue.manifest['settings'],
+                         cache_path=nlp.cache.cache_path if nlp.cache else None,
+                         cache_max_mb=nlp.cache.max_bytes//(1024*1024) if nlp.cache else 1024)
+    results = {}
+    hosts = {}
+    merged = set()
+    last_log = time.perf_counter()
+    while len(merged) < len(queue.units):
+        for unit in queue.units:
+            if unit in merged:
+                continue
+            if queue.has_failed(unit):
+                failures = queue.failures(unit)
+                queue.finish(keep=True)
+                raise WorkUnitFailedError(f'NER work unit {unit} failed {failures["attempts"]} times, last on '
+                                          f'{failures["error"]}, run kept in {queue.run_dir}')
+            if queue.claim_pending(unit):
+                run_unit(queue, unit, local)
+            result = queue.read_result(unit)
+            if result is None:
+                continue
+            results.update(result['results'])
+            nlp.merge_unit_stats(*result['stats'])
+            hosts[result['host']] = hosts.get(result['host'], 0) + 1
+            merged.add(unit)
+            if progress:
+                progress(len(result['results']))
+        if len(merged) < len(queue.units):
+            if time.perf_counter() - last_log >= 60:
+                logger.info(f'waiting on {len(queue.units) - len(merged)} NER work units, held by {queue.holders()}')
+                last_log = time.perf_counter()
+            time.sleep(poll_seconds)
+    queue.finish()
+    logger.info(f'merged {len(queue.units)} NER work units, units per host: {hosts}')
+    return {incident_id: results[incident_id] for incident_id in texts}
+
+
+def work(work_dir:Path, stale_seconds:int=STALE_SECONDS, poll_seconds:float=POLL_SECONDS,
+         exit_when_idle:bool=False, cache_path:str=None, cache_max_mb:int=1024):
+    """
+    worker loop: work on the units of every unfinished run in work_dir,
+    waiting poll_seconds for new runs when there is nothing to do. Runs of
+    another work queue version, or whose run_signature differs from this
+    host's, e.g. different model files under the same model path, are skipped.
+    :param cache_path: optional SQLite NER cache on this host
+    """
+    work_dir = Path(work_dir)
+    logger.info(f'NER worker {socket.gethostname()} {os.getpid()} watching {work_dir}')
+    skipped = set()
+    while True:
+        count = 0
+        for manifest_path in sorted(work_dir.glob('run-*/manifest.json')):
+            if manifest_path.parent in skipped:
+                continue
+            try:
+                queue = WorkQueue(manifest_path.parent, stale_seconds)
+                if queue.is_finished():
+                    continue
+                if queue.manifest['version'] != QUEUE_VERSION:
+                    logger.warning(f'skipping {queue.run_dir}, written by work queue version {queue.manifest["version"]}')
+                    skipped.add(queue.run_dir)
+                    continue
+                nlp = get_pipeline(queue.manifest['settings'], cache_path, cache_max_mb)
+                signature = run_signature(nlp)
+                if signature != queue.manifest['signature']:
+                    logger.warning(f'skipping {queue.run_dir}, run with NER signature {queue.manifest["signature"]}, '
+                                   f'not this host\'s {signature}')
+                    skipped.add(queue.run_dir)
+                    continue
+                count += work_on(queue, nlp)
+            except FileNotFoundError:
+                # the coordinator removed the run
+                continue
+        if not count:
+            if exit_when_idle:
+                break
+            time.sleep(poll_seconds)
+
+
+@click.command()
+@click.option('--work_dir', type=click.Path(), required=True, help = 'directory shared with ApolloDetector runs given it as --distributed_dir')
+@click.option('--stale_seconds', type=int, default=STALE_SECONDS, help = 'seconds after which a work unit whose worker stopped updating its lock is claimed again')
+@click.option('--poll_seconds', type=float, default=POLL_SECONDS, help = 'seconds between looks for new work units when idle')
+@click.option('--exit_when_idle/--no-exit_when_idle', default=False, help = 'exit once there are no work units left instead of waiting for more')
+@click.option('--ner_cache', type=click.Path(), help = 'SQLite file on this host caching NER model predictions across runs, default: no caching')
+@click.option('--ner_cache_max_mb', type=int, default=1024, help = 'size in MB above which the NER cache evicts least recently used entries')
+def main(work_dir, stale_seconds, poll_seconds, exit_when_idle, ner_cache, ner_cache_max_mb):
+    """
+    Run NER over work units written by distributed ApolloDetector runs
+    """
+    logging.basicConfig(format='%(levelname)s :: %(filename)s :: %(funcName)s :: %(asctime)s :: %(message)s', level=logging.INFO)
+    work(work_dir, stale_seconds, poll_seconds, exit_when_idle, ner_cache, ner_cache_max_mb)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Store of per-incident NER results carried over between runs.
+
+WEDSS extracts are refreshed daily but most incidents' text does not change
+from one day to the next, and reports for overlapping periods see the same
+incidents again and again. The store keeps, per IncidentID, a hash of the
+incident's concatenated WEDSS text and the NER result for that text, so a
+run only has to run NER over incidents that are new or whose text has
+changed. Incidents not seen for keep_runs runs, e.g. that fell out of every
+reporting period, are pruned so the store does not grow without limit.
+"""
+from pathlib import Path
+from typing import Dict, Tuple
+import hashlib
+import logging
+import pickle
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+STORE_VERSION = '5'  # bump when the stored result format or results change
+KEEP_RUNS = 30
+
+
+class IncrementalNERStore:
+    """
+    SQLite manifest of incidentID -> (text hash, NER result)
+
+    A NER result of None records that the incident's text was dropped by
+    wedss_text_filter. If the store was written with a different signature
+    (e.g. another model) it is cleared when opened.
+
+    attributes:
+    store_path: SQLite database file
+    signature: str identifying the cleaning rules and model results depend on
+    run: number of times the store has been opened, each opening is a run
+    keep_runs: incidents not seen in this many runs are pruned when the
+    store is opened
+    """
+    def __init__(self, store_path: Path, signature: str = '', keep_runs: int = KEEP_RUNS):
+        self.store_path = Path(store_path)
+        self.store_path.parent.mkdir(parents=True, exist_ok=True)
+        self.signature = f'{STORE_VERSION}:{signature}'
+        self.keep_runs = keep_runs
+        # used from one thread at a time, not always the one opening it, e.g.
+        # by the cleaning stage of a streaming run
+        self.connection = sqlite3.connect(str(self.store_path), check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        stored = self.connection.execute("SELECT value FROM meta WHERE key='signature'").fetchone()
+        if stored != (self.signature,):
+            if stored:
+                logger.info(f'incremental store {self.store_path} was built with {stored[0]}, clearing it')
+            # recreated, stores of older versions have other columns
+            self.connection.execute("DROP TABLE IF EXISTS incidents")
+            self.connection.execute("DELETE FROM meta")
+            self.connection.execute("INSERT INTO meta VALUES ('signature', ?)", (self.signature,))
+        # last_run: the last run the incident was seen in
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS incidents (incident_id TEXT PRIMARY KEY,
+                                       text_hash TEXT, result BLOB, last_run INTEGER)""")
+        stored_run = self.connection.execute("SELECT value FROM meta WHERE key='run'").fetchone()
+        self.run = int(stored_run[0]) + 1 if stored_run else 1
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('run', ?)", (str(self.run),))
+        pruned = self.connection.execute("DELETE FROM incidents WHERE last_run <= ?",
+                                         (self.run - self.keep_runs - 1,)).rowcount
+        self.connection.commit()
+        if pruned:
+            logger.info(f'incremental store: pruned {pruned} incidents not seen in the last {self.keep_runs} runs')
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def split(self, raw_wedss_text: Dict) -> Tuple[Dict, Dict, Dict]:
+        """
+        sort incidents into those that need processing and those whose stored
+        result can be reused.
+        :param raw_wedss_text: {incidentID: all WEDSS text for the incident}
+        :return: changed {incidentID: text} new or changed incidents,
+        reused {incidentID: [[entities], [types], [scores]] or None} unchanged incidents,
+        hashes {incidentID: text hash} for every incident
+        """
+        hashes = {k: self.text_hash(v) for k, v in raw_wedss_text.items()}
+        stored = {}
+        cursor = self.connection.cursor()
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (incident_id TEXT PRIMARY KEY)")
+        cursor.execute("DELETE FROM wanted")
+        cursor.executemany("INSERT OR IGNORE INTO wanted VALUES (?)", ((k,) for k in hashes))
+        for incident_id, text_hash, result in cursor.execute(
+                "SELECT incidents.incident_id, text_hash, result FROM incidents "
+                "JOIN wanted ON incidents.incident_id = wanted.incident_id"):
+            stored[incident_id] = (text_hash, result)
+        cursor.execute("UPDATE incidents SET last_run = ? WHERE incident_id IN (SELECT incident_id FROM wanted)",
+                       (self.run,))
+        self.connection.commit()
+
+        changed = {}
+        reused = {}
+        for incident_id, text in raw_wedss_text.items():
+            previous = stored.get(incident_id)
+            if previous and previous[0] == hashes[incident_id]:
+                reused[incident_id] = pickle.loads(previous[1]) if previous[1] is not None else None
+            else:
+                changed[incident_id] = text
+        logger.info(f'incremental store: {len(reused)} unchanged incidents reused, {len(changed)} new or changed')
+        return changed, reused, hashes
+
+    def update(self, hashes: Dict, results: Dict):
+        """
+        record the NER results of newly processed incidents
+        :param hashes: {incidentID: text hash} of the processed incidents
+        :param results: {incidentID: [[entities], [types], [scores]]}, incidents
+        missing from results were dropped by the text filter
+        """
+        rows = []
+        for incident_id, text_hash in hashes.items():
+            result = results.get(incident_id)
+            if result is not None:
+                # pickled so reused results are identical to fresh ones, score types included
+                result = pickle.dumps(result)
+            rows.append((incident_id, text_hash, result, self.run))
+        self.connection.executemany("INSERT OR REPLACE INTO incidents VALUES (?,?,?,?)", rows)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
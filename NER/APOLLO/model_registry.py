@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Process wide registry of loaded NER models.
+
+Loading the tokenizer and model from disk takes seconds, and run_apollo.py
+builds a new ApolloDetector, and with it a NERPipeline, for every report.
+NERPipeline asks the registry for its model on its first inference call, and
+the registry loads each model path once per process: every later pipeline,
+detector and run in the process shares the loaded tokenizer, model and
+backends, as do forked NER workers. transformers and torch are only imported
+on the first load, so e.g. --help does not pay for them.
+"""
+from pathlib import Path
+from typing import Dict
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_PATH = "APOLLO/bert-base-NER"
+
+_lock = threading.RLock()
+_models = {}  # model path -> (tokenizer, model)
+_backends = {}  # (model path, backend name) -> LoadedNERModel
+_configs = {}  # model path -> config.json contents
+
+
+class LoadedNERModel:
+    """
+    attributes:
+    model_path: directory the model was loaded from
+    tokenizer: AutoTokenizer
+    model: AutoModelForTokenClassification in eval mode
+    backend: ner_backends backend computing the model's logits
+    backend_name: one of ner_backends.BACKENDS
+    """
+    def __init__(self, model_path:str, tokenizer, model, backend, backend_name:str):
+        self.model_path = model_path
+        self.tokenizer = tokenizer
+        self.model = model
+        self.backend = backend
+        self.backend_name = backend_name
+
+
+def get_model_config(model_path:str=DEFAULT_MODEL_PATH) -> Dict:
+    """
+    :return: the model's config.json, read without loading the model
+    """
+    with _lock:
+        if model_path not in _configs:
+            with (Path(model_path) / 'config.json').open('r') as f:
+                _configs[model_path] = json.load(f)
+        return _configs[model_path]
+
+
+def _load_model(model_path:str):
+    if model_path not in _models:
+        from transformers import AutoTokenizer, AutoModelForTokenClassification
+        start = time.perf_counter()
+        tokenizer = AutoTokenizer.from_pretrained(model_path, local_files_only=True)
+        model = AutoModelForTokenClassification.from_pretrained(model_path, local_files_only=True)
+        model.eval()
+        _models[model_path] = (tokenizer, model)
+        logger.info(f'loaded NER model {model_path} in {time.perf_counter() - start:.2f}s')
+    return _models[model_path]
+
+
+def get_ner_model(model_path:str=DEFAULT_MODEL_PATH, backend:str='torch') -> LoadedNERModel:
+    """
+    load model_path and its backend on the first call for them in this process
+    and run one warm-up forward pass, later calls return the same objects.
+    :param model_path: directory of the model and tokenizer files
+    :param backend: one of ner_backends.BACKENDS
+    :return: LoadedNERModel
+    """
+    with _lock:
+        key = (model_path, backend)
+        if key not in _backends:
+            import numpy as np
+            from ner_backends import load_backend
+            tokenizer, model = _load_model(model_path)
+            start = time.perf_counter()
+            loaded_backend = load_backend(backend, model, model_path)
+            logger.info(f'started {backend} NER backend for {model_path} in {time.perf_counter() - start:.2f}s')
+            # the first forward pass is slower, e.g. allocations and onnx graph setup
+            start = time.perf_counter()
+            warm_up = np.array([[tokenizer.cls_token_id, tokenizer.sep_token_id]], dtype=np.int64)
+            loaded_backend.logits(warm_up, np.ones_like(warm_up))
+            logger.info(f'warmed up {backend} NER backend in {time.perf_counter() - start:.2f}s')
+            _backends[key] = LoadedNERModel(model_path, tokenizer, model, loaded_backend, backend)
+        return _backends[key]
+
+
+def clear():
+    """
+    drop every loaded model, e.g. to free memory between runs
+    """
+    with _lock:
+        _models.clear()
+        _backends.clear()
+        _configs.clear()
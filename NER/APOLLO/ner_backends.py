@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Inference backends for NERPipeline.
+
+Every backend turns a batch of padded token ids into token classification
+logits, so NERPipeline decodes the output of all of them the same way:
+    torch: the PyTorch model in full precision
+    torch_int8: the PyTorch model with its Linear layers dynamically
+    quantized to INT8
+    onnx: the model exported to ONNX and run with ONNX Runtime on CPU,
+    onnxruntime is only needed for this backend
+
+Run as a script to compare the entities every backend finds, and its speed,
+on a fixed corpus, e.g. a processed_WEDDS_text output file.
+"""
+from pathlib import Path
+from typing import List, Dict
+import csv
+import importlib.util
+import logging
+import os
+import tempfile
+import time
+
+import click
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('torch', 'torch_int8', 'onnx')
+ONNX_OPSET = 14
+
+
+class TorchBackend:
+    """
+    attributes:
+    model: AutoModelForTokenClassification in eval mode
+    """
+    def __init__(self, model):
+        self.model = model.eval()
+
+    def logits(self, input_ids:np.ndarray, attention_mask:np.ndarray) -> np.ndarray:
+        """
+        :param input_ids: int64 array (batch, sequence)
+        :param attention_mask: int64 array (batch, sequence)
+        :return: float32 array (batch, sequence, labels)
+        """
+        with torch.no_grad():
+            return self.model(input_ids=torch.from_numpy(input_ids),
+                              attention_mask=torch.from_numpy(attention_mask)).logits.numpy()
+
+    def set_num_threads(self, threads:int):
+        """
+        limit the threads one forward pass uses, e.g. in a forked worker
+        """
+        torch.set_num_threads(threads)
+
+
+class TorchInt8Backend(TorchBackend):
+    """
+    TorchBackend with the model's Linear layers dynamically quantized to INT8
+    """
+    def __init__(self, model):
+        quantized = torch.ao.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+        super().__init__(quantized)
+
+
+class OnnxBackend:
+    """
+    the model exported to onnx_path, run with an ONNX Runtime CPU session.
+    The export is redone when any model file is newer than onnx_path.
+
+    attributes:
+    onnx_path: exported model file
+    session: onnxruntime InferenceSession
+    """
+    def __init__(self, model, model_dir:Path, onnx_path:Path=None):
+        if importlib.util.find_spec('onnxruntime') is None:
+            raise ImportError('the onnx NER backend needs onnxruntime: pip install onnxruntime')
+        model_dir = Path(model_dir)
+        self.onnx_path = Path(onnx_path) if onnx_path else model_dir.parent / (model_dir.name + '.onnx')
+        newest_model_file = max(p.stat().st_mtime_ns for p in model_dir.rglob('*') if p.is_file())
+        if not self.onnx_path.exists() or self.onnx_path.stat().st_mtime_ns < newest_model_file:
+            self.export(model, self.onnx_path)
+        self._start_session()
+
+    def _start_session(self, threads:int=0):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(str(self.onnx_path), options,
+                                                    providers=['CPUExecutionProvider'])
+
+    @staticmethod
+    def export(model, onnx_path:Path):
+        logger.info(f'exporting NER model to {onnx_path}')
+        dummy = torch.ones((1, 8), dtype=torch.long)
+        dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in ('input_ids', 'attention_mask', 'logits')}
+        # a temp file of its own, so workers exporting at once don't write
+        # into each other's file, then an atomic rename into place
+        fd, tmp_name = tempfile.mkstemp(dir=onnx_path.parent, suffix='.onnx.tmp')
+        os.close(fd)
+        tmp_path = Path(tmp_name)
+        try:
+            torch.onnx.export(model.eval(), (dummy, dummy), tmp_name,
+                              input_names=['input_ids', 'attention_mask'],
+                              output_names=['logits'],
+                              dynamic_axes=dynamic_axes,
+                              opset_version=ONNX_OPSET,
+                              dynamo=False)
+            tmp_path.replace(onnx_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def set_num_threads(self, threads:int):
+        """
+        limit the threads one forward pass uses. ONNX Runtime sessions don't
+        survive a fork, so this also gives a forked worker its own session.
+        """
+        self._start_session(threads)
+
+    def logits(self, input_ids:np.ndarray, attention_mask:np.ndarray) -> np.ndarray:
+        return self.session.run(['logits'], {'input_ids': input_ids,
+                                             'attention_mask': attention_mask})[0]
+
+
+def load_backend(name:str, model, model_dir:Path, onnx_path:Path=None):
+    """
+    :param name: one of BACKENDS
+    :param model: loaded AutoModelForTokenClassification
+    :param model_dir: directory the model was loaded from
+    :param onnx_path: where to keep the ONNX export, default model_dir + '.onnx'
+    :return: backend with a logits(input_ids, attention_mask) method
+    """
+    if name == 'torch':
+        return TorchBackend(model)
+    if name == 'torch_int8':
+        return TorchInt8Backend(model)
+    if name == 'onnx':
+        return OnnxBackend(model, model_dir, onnx_path)
+    raise ValueError(f'NER backend must be one of {BACKENDS}, not {name!r}')
+
+
+def compare_backends(texts:List, backends:List=BACKENDS, reference:str='torch', batch_size:int=8) -> Dict:
+    """
+    run NER over texts with each backend and compare the entities found
+    against the reference backend
+    :param texts: fixed corpus, list of str
+    :return: {backend: [seconds, texts with identical entity sets pc, mean
+    jaccard similarity of entity sets, entities found]}
+    """
+    from NERPipeline import NERPipeline
+
+    entity_sets = {}
+    seconds = {}
+    for name in backends:
+        nlp = NERPipeline(batch_size=batch_size, backend=name)
+        start = time.perf_counter()
+        results = nlp.ner_over_texts(texts)
+        seconds[name] = time.perf_counter() - start
+        entity_sets[name] = [set(x.strip() for x in entities) for entities, _, _ in results]
+
+    comparison = {}
+    for name in backends:
+        identical = 0
+        jaccard = []
+        for found, expected in zip(entity_sets[name], entity_sets[reference]):
+            identical += found == expected
+            union = found | expected
+            jaccard.append(len(found & expected)/len(union) if union else 1.0)
+        comparison[name] = [round(seconds[name], 3),
+                            round(100*identical/len(texts), 2) if texts else 100.0,
+                            round(float(np.mean(jaccard)), 4) if jaccard else 1.0,
+                            sum(len(x) for x in entity_sets[name])]
+    return comparison
+
+
+@click.command()
+@click.option('--corpus', type=click.Path(exists=True), required=True, help = 'csv file with the text to compare on in its second column, e.g. a processed_WEDDS_text output file')
+@click.option('--output', type=click.Path(), default='ner_backend_comparison.csv', help = 'file to write the comparison to')
+@click.option('--backends', type=str, default=','.join(BACKENDS), help = 'comma separated backends to compare')
+@click.option('--batch_size', type=int, default=8, help = 'number of text windows per forward pass')
+def main(corpus, output, backends, batch_size):
+    """
+    Compare NER backends' entities and speed on a fixed corpus
+    """
+    csv.field_size_limit(2**31-1)
+    with open(corpus, 'r', newline='') as f:
+        rows = csv.reader(f)
+        next(rows, None)
+        texts = [row[1] for row in rows if len(row) > 1]
+    backends = [x.strip() for x in backends.split(',')]
+    comparison = compare_backends(texts, backends, reference=backends[0], batch_size=batch_size)
+    with open(output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['backend', 'seconds', 'identical entity sets pc', 'mean jaccard', 'entities'])
+        for name, values in comparison.items():
+            writer.writerow([name] + values)
+            print(name, values)
+
+
+if __name__ == '__main__':
+    main()
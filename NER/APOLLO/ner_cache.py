@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent content addressed cache of NER model predictions.
+
+Entries are keyed by a hash of the model fingerprint (model and tokenizer
+files) and the token ids of one model input window, and hold the label and
+score predicted for every token of the window. Reports over overlapping
+periods, or the same report run twice, find most of their windows here and
+skip the forward pass for them.
+
+The cache is bounded in size: when it grows past max_bytes the least
+recently used entries are evicted. The total size of the entries is kept
+up to date by triggers in a meta row, so checking it costs one lookup.
+"""
+from pathlib import Path
+from typing import List, Dict, Tuple
+import hashlib
+import logging
+import sqlite3
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+EVICT_BATCH = 1000  # entries deleted per eviction query
+
+
+def model_fingerprint(model_dir: Path, *extra: str) -> str:
+    """
+    :param model_dir: directory of the model and tokenizer files
+    :param extra: other settings predictions depend on, e.g. the backend
+    :return: hash of the name, size and modification time of every file in
+    model_dir and of extra
+    """
+    files = []
+    for path in sorted(Path(model_dir).rglob('*')):
+        if path.is_file():
+            stat = path.stat()
+            files.append((str(path.relative_to(model_dir)), stat.st_size, stat.st_mtime_ns))
+    return hashlib.sha1(repr((CACHE_VERSION, files, extra)).encode('utf-8')).hexdigest()
+
+
+class NERChunkCache:
+    """
+    SQLite cache of window token ids -> (label index per token, score per token)
+
+    attributes:
+    cache_path: SQLite database file
+    fingerprint: model fingerprint mixed into every key
+    max_bytes: size of cached predictions above which entries are evicted
+    hits, misses, evictions: counters since the cache was opened
+    """
+    def __init__(self, cache_path: Path, fingerprint: str, max_bytes: int = 1 << 30):
+        self.cache_path = Path(cache_path)
+        self.fingerprint = fingerprint.encode('utf-8')
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._connection = None
+        self._connect()
+
+    def _connect(self):
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # several NER workers may write at once. The connection may be used
+        # by a thread other than the one opening it, e.g. a streaming NER
+        # stage, but only by one thread at a time
+        self._connection = sqlite3.connect(str(self.cache_path), timeout=120, check_same_thread=False)
+        self._connection.executescript("""
+            BEGIN IMMEDIATE;
+            CREATE TABLE IF NOT EXISTS chunks (key BLOB PRIMARY KEY, labels BLOB, scores BLOB,
+                                               size INTEGER, last_used INTEGER);
+            CREATE INDEX IF NOT EXISTS chunks_last_used ON chunks (last_used);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+            INSERT OR IGNORE INTO meta SELECT 'total size', COALESCE(SUM(size), 0) FROM chunks;
+            CREATE TRIGGER IF NOT EXISTS chunks_insert AFTER INSERT ON chunks BEGIN
+                UPDATE meta SET value = value + NEW.size WHERE key = 'total size';
+            END;
+            CREATE TRIGGER IF NOT EXISTS chunks_delete AFTER DELETE ON chunks BEGIN
+                UPDATE meta SET value = value - OLD.size WHERE key = 'total size';
+            END;
+            COMMIT;
+            """)
+        self._clock = (self._connection.execute("SELECT MAX(last_used) FROM chunks").fetchone()[0] or 0) + 1
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __getstate__(self):
+        # sqlite connections can't be sent to other processes, they reconnect
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._connect()
+
+    def reconnect(self):
+        """
+        open a new connection, e.g. in a forked worker: a connection must not
+        be used by more than one process
+        """
+        # keep the inherited connection referenced, closing it here could
+        # release locks the parent process holds
+        self._inherited_connection = self._connection
+        self._connect()
+
+    def key(self, input_ids: List) -> bytes:
+        """
+        :param input_ids: token ids of one model input window
+        :return: cache key of the window
+        """
+        return hashlib.sha1(self.fingerprint + np.asarray(input_ids, dtype=np.int32).tobytes()).digest()
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, Tuple[np.ndarray, np.ndarray]]:
+        """
+        :param keys: window keys
+        :return: {key: (label indexes, scores)} for the keys in the cache
+        """
+        connection = self._connection
+        connection.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (key BLOB PRIMARY KEY)")
+        connection.execute("DELETE FROM wanted")
+        connection.executemany("INSERT OR IGNORE INTO wanted VALUES (?)", ((k,) for k in keys))
+        # end the implicit transaction so the read below holds no lock while
+        # waiting to write: two workers reading then writing in one
+        # transaction each would deadlock
+        connection.commit()
+        found = {key: (np.frombuffer(labels, dtype=np.int16), np.frombuffer(scores, dtype=np.float32))
+                 for key, labels, scores in connection.execute(
+                     "SELECT chunks.key, labels, scores FROM chunks JOIN wanted ON chunks.key = wanted.key")}
+        if found:
+            connection.execute("UPDATE chunks SET last_used = ? WHERE key IN (SELECT key FROM wanted)",
+                               (self._clock,))
+            self._clock += 1
+            connection.commit()
+        hits = sum(1 for k in keys if k in found)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return found
+
+    def put_many(self, entries: List[Tuple[bytes, np.ndarray, np.ndarray]]):
+        """
+        :param entries: [(key, label indexes, scores)] of newly predicted windows
+        """
+        rows = []
+        for key, labels, scores in entries:
+            labels = np.asarray(labels, dtype=np.int16).tobytes()
+            scores = np.asarray(scores, dtype=np.float32).tobytes()
+            rows.append((key, labels, scores, len(labels) + len(scores), self._clock))
+        # a key's predictions never change, so a window another worker stored
+        # meanwhile is kept, and the size triggers see no replaced rows
+        self._connection.executemany("INSERT OR IGNORE INTO chunks VALUES (?,?,?,?,?)", rows)
+        self._clock += 1
+        self._connection.commit()
+        self.evict()
+
+    def total_size(self) -> int:
+        """
+        :return: total size in bytes of the cached predictions
+        """
+        return self._connection.execute("SELECT value FROM meta WHERE key = 'total size'").fetchone()[0]
+
+    def evict(self):
+        """
+        drop least recently used entries, EVICT_BATCH at a time, until the
+        cache is back under 90% of max_bytes
+        """
+        connection = self._connection
+        total = self.total_size()
+        if total <= self.max_bytes:
+            return
+        target = 0.9*self.max_bytes
+        evicted = 0
+        while total > target:
+            batch = []
+            for key, size in connection.execute("SELECT key, size FROM chunks ORDER BY last_used LIMIT ?",
+                                                (EVICT_BATCH,)).fetchall():
+                if total <= target:
+                    break
+                batch.append((key,))
+                total -= size
+            if not batch:
+                break
+            connection.executemany("DELETE FROM chunks WHERE key = ?", batch)
+            connection.commit()
+            evicted += len(batch)
+            # other workers may have added or evicted entries meanwhile
+            total = self.total_size()
+        self.evictions += evicted
+        logger.info(f'evicted {evicted} entries from NER cache {self.cache_path}')
+
+    def get_stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {'ner cache hits': self.hits,
+                'ner cache misses': self.misses,
+                'ner cache hit rate pc': round(100*self.hits/lookups, 2) if lookups else 0,
+                'ner cache evictions': self.evictions}
@@ -4,14 +4,17 @@ Created on Fri Nov 12 13:44:31 2021
 
 @author: imcconnell2
 """
-from datetime import date, datetime, timedelta
+from datetime import date
 from dateutil.relativedelta import relativedelta
-import calendar
 import pandas as pd
 from pathlib import Path
 from typing import List
 import logging
 from tqdm import tqdm
+import click
+
+from patient_cache import PatientColumnCache
+from date_periods import DatePeriod
 
 logging.basicConfig(format='%(levelname)s :: %(filename)s :: %(funcName)s :: %(asctime)s :: %(message)s', level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -22,7 +25,7 @@ class OutbreakChunker:
     """open patient and outbreak files. get all positive patient ids per month
     use those ids to break out outbreaks with postive ids per month
     A lot of this code duplicated from APOLLODetector"""
-    def __init__(self, filepath, output_path):
+    def __init__(self, filepath, output_path, cache_dir=None):
         self.filepath = Path(filepath)
         if not self.filepath.is_dir():
             raise NotADirectoryError()
@@ -33,6 +36,11 @@ class OutbreakChunker:
         self.output_path = Path(output_path) / "outbreak_chunks"
         self.output_path.mkdir(parents=True, exist_ok=True)
         
+        # opt-in columnar cache of the patient file, see patient_cache.py
+        self.patient_cache = None
+        if cache_dir:
+            self.patient_cache = PatientColumnCache(self.patient_file, cache_dir).load()
+        
     
     def set_date_range(self, day, period) -> List:
         """
@@ -43,54 +51,25 @@ class OutbreakChunker:
                             'trailing_seven_days': the six days leading up to 'day' plus that day.
                             'month': all the days in the month of 'day'
                             'all': returns string 'all' rather than list of dates - date checker function 'date_in_range' knows what that means .
-        :return: self.date_range = List of datetimes
+        :return: self.date_range = List of datetimes, self.date_period = the
+        same period compiled to a DatePeriod interval
         """
         
         try:
-            d=day.split(" ")
-            d=d[0]
-            d=(datetime.strptime(d,'%Y-%m-%d'))
-            d=d.date()
-            if period == 'week':
-                day_of_week = d.isocalendar()[2]-1
-                start_date = d - timedelta(days=day_of_week)
-                self.date_range = [start_date + timedelta(days=i) for i in range(7)]
-            if period == 'trailing_seven_days':
-                start_date = d
-                self.date_range = [start_date - timedelta(days=i) for i in range(7)]                  
-            if period == 'month':
-                number_of_days = calendar.monthrange(d.year,d.month)[1]
-                self.date_range = [date(d.year, d.month, day) for day in range(1, number_of_days+1)]
-            if period == 'all':
-                self.date_range = 'all'                
-            if period not in ['week','month','all','trailing_seven_days']:
-                raise ValueError("period type must be 'week', 'month', trailing_seven_days' or 'all'")
+            self.date_period = DatePeriod(day, period)
+            self.date_range = self.date_period.dates
         except (IndexError, ValueError):
-            logger.error(f"Couldn't set date range with {type(d)}:{d} and {type(period)}:{period}")
+            logger.error(f"Couldn't set date range with {type(day)}:{day} and {type(period)}:{period}")
            
             
     def date_in_range(self, date:str) -> bool:
         """
-        helper function compare date to list of dates in range, return True if
-        in range, else False. If period is 'all', always return True.
+        helper function compare date to the range of dates in self.date_period,
+        return True if in range, else False. If period is 'all', always return True.
         :param date: plain text date in format "YYYY-MM-DD <stuff>"
         :return: True if date in range, else False. If can't convert date return False.
         """
-        if self.date_range == 'all':
-            return True
-        try:
-            d=date.split(" ")
-            d=d[0]
-            d=(datetime.strptime(d,'%Y-%m-%d'))
-            d=d.date()
-            if d in self.date_range:
-                return True
-            else:
-                return False
-                
-        except (IndexError,ValueError):
-            logger.warning(f"not a valid date value: {d}")
-            return False
+        return self.date_period.contains(date)
 
 
     def get_ids(self, target_date:str='', period:str='week', 
@@ -108,14 +87,27 @@ class OutbreakChunker:
         :return: self.ids - dict of relevant incident ids {incident_id:1}
         """
 
+        logger.debug(f'target_date: {target_date}')
+        logger.debug(f'period: {period}')
+        # establish dates of interest
+        self.set_date_range(target_date, period)
+        logger.debug(f'searching from {self.date_range[0]} to {self.date_range[-1]}')
+        usable_resolution_statues = ["Confirmed", "Probable"]
+        
+        if self.patient_cache:
+            matches, any_counter = self.patient_cache.select(
+                self.patient_cache.date_mask(self.date_period),
+                search_county,
+                usable_resolution_statues)
+            ids = {incidentID:1 for incidentID in matches}
+            print(f'total any status cases, in Dane county, in week of specified date:{any_counter}')            
+            print(f'total confirmed cases, in Dane county, in week of specified date:{len(matches)}')
+            self.ids=ids
+            return
+        
         with self.patient_file.open('r', encoding='ISO-8859-1') as f: 
             f.seek(0)
             lines=f.readlines()
-            logger.debug(f'target_date: {target_date}')
-            logger.debug(f'period: {period}')
-            # establish dates of interest
-            self.set_date_range(target_date, period)
-            logger.debug(f'searching from {self.date_range[0]} to {self.date_range[-1]}')
             
             # for every line in patient file (not including header row), where:
               # EpisodeDate not empty string and in specified week
@@ -125,12 +117,12 @@ class OutbreakChunker:
             confirmed_counter = 0
             any_counter = 0
             ids={}
-            usable_resolution_statues = ["Confirmed", "Probable"]
             for count, line in tqdm(enumerate(lines)):
                 header_row = False
                 if count == 0:
                     header_row = True
-                ls=line.split("|")
+                # only split as far as the last column used
+                ls=line.split("|", 34)
                 incidentID = ls[0]
                 episode_date = ls[18]
                 county = ls[8]
@@ -138,8 +130,8 @@ class OutbreakChunker:
                 
                 if not header_row\
                     and episode_date!=''\
-                    and self.date_in_range(episode_date)\
-                    and county==search_county:
+                    and county==search_county\
+                    and self.date_period.contains(episode_date):
                         
                     any_counter += 1
                     
@@ -195,8 +187,9 @@ class OutbreakChunker:
 @click.option('--output_path', type=click.Path(exists=True))
 @click.option('--start_from', type=str, default='2021-06-01')  
 @click.option('--number_of_months_to_run', type=int, default='12')    
-def main(NLP_files_path, output_path, start_from, number_of_months_to_run):         
-    c = OutbreakChunker(NLP_files_path, output_path)
+@click.option('--cache_dir', type=click.Path(), default=None)
+def main(NLP_files_path, output_path, start_from, number_of_months_to_run, cache_dir):         
+    c = OutbreakChunker(NLP_files_path, output_path, cache_dir)
     c.blow_chunks(start_from, number_of_months_to_run)
     
 if __name__ == '__main__':
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of the entities NER finds in outbreak names.
+
+map_incidents_to_outbreaks runs every linked outbreak's Outbreak# and
+OutbreakLocation, joined into one string, through NER. Outbreaks stay open
+for weeks, so the same strings come back run after run. The cache keeps, per
+Outbreak#, the string that was run through NER and the entities found in it,
+so only new outbreaks and outbreaks whose name or location changed go
+through the model.
+
+The cache is a JSON file, cleared when its signature changes: ApolloDetector
+signs it with NERPipeline.signature(), which includes the fingerprint of the
+model files, so a model retrained in place clears it as a settings change does.
+"""
+from pathlib import Path
+from typing import List
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+
+
+class OutbreakNERCache:
+    """
+    Outbreak# -> (outbreak string run through NER, entities)
+
+    attributes:
+    cache_path: JSON file
+    signature: str identifying the NER model and settings entities depend on
+    outbreaks: {Outbreak#: [outbreak string, [entities]]}
+    """
+    def __init__(self, cache_path: Path, signature: str = ''):
+        self.cache_path = Path(cache_path)
+        self.signature = f'{CACHE_VERSION}:{signature}'
+        self.outbreaks = {}
+
+    def load(self) -> 'OutbreakNERCache':
+        """
+        read the cache file, if there is one built with the same signature
+        """
+        if self.cache_path.exists():
+            with self.cache_path.open('r') as f:
+                cached = json.load(f)
+            if cached.get('signature') == self.signature:
+                self.outbreaks = cached['outbreaks']
+            else:
+                logger.info(f'outbreak NER cache {self.cache_path} was built with {cached.get("signature")}, clearing it')
+        return self
+
+    def get(self, outbreak_id: str, text: str) -> List:
+        """
+        :param outbreak_id: Outbreak#
+        :param text: the outbreak string to run through NER
+        :return: the entities cached for the outbreak, or None if it isn't
+        cached or its string has changed
+        """
+        cached = self.outbreaks.get(outbreak_id)
+        if cached and cached[0] == text:
+            return cached[1]
+        return None
+
+    def put(self, outbreak_id: str, text: str, entities: List):
+        self.outbreaks[outbreak_id] = [text, list(entities)]
+
+    def save(self):
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cache_path.with_suffix('.tmp')
+        with tmp_path.open('w') as f:
+            json.dump({'signature': self.signature, 'outbreaks': self.outbreaks}, f)
+        tmp_path.replace(self.cache_path)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Rule based parser of WEDSS outbreak names.
+
+Outbreak# values are structured, e.g. 2021-DANE TYPICAL ELEMENTARY SCHOOL:
+the year, the county joined to it by a hyphen, then the name of the place
+the outbreak is at. The year and county never help to match an outbreak to
+the entities found in incident text, the place name and OutbreakLocation
+do. outbreak_match_keys strips the prefix and normalizes the place name and
+location into the keys incident entities are matched against, without
+running them through NER.
+"""
+from typing import List, Dict, Tuple
+import re
+
+from fuzzywuzzy import fuzz
+
+WISCONSIN_COUNTIES = [
+    'Adams', 'Ashland', 'Barron', 'Bayfield', 'Brown', 'Buffalo', 'Burnett', 'Calumet',
+    'Chippewa', 'Clark', 'Columbia', 'Crawford', 'Dane', 'Dodge', 'Door', 'Douglas',
+    'Dunn', 'Eau Claire', 'Florence', 'Fond du Lac', 'Forest', 'Grant', 'Green',
+    'Green Lake', 'Iowa', 'Iron', 'Jackson', 'Jefferson', 'Juneau', 'Kenosha',
+    'Kewaunee', 'La Crosse', 'Lafayette', 'Langlade', 'Lincoln', 'Manitowoc',
+    'Marathon', 'Marinette', 'Marquette', 'Menominee', 'Milwaukee', 'Monroe', 'Oconto',
+    'Oneida', 'Outagamie', 'Ozaukee', 'Pepin', 'Pierce', 'Polk', 'Portage', 'Price',
+    'Racine', 'Richland', 'Rock', 'Rusk', 'St. Croix', 'Sauk', 'Sawyer', 'Shawano',
+    'Sheboygan', 'Taylor', 'Trempealeau', 'Vernon', 'Vilas', 'Walworth', 'Washburn',
+    'Washington', 'Waukesha', 'Waupaca', 'Waushara', 'Winnebago', 'Wood',
+    ]
+
+# longest county names first, so Green Lake is not taken for Green
+_COUNTY = '|'.join(re.escape(county).replace(r'\ ', r'\s+').replace(r'\.', r'\.?')
+                   for county in sorted(WISCONSIN_COUNTIES, key=len, reverse=True))
+# the year, optionally a known county joined to it by a hyphen. Any other word
+# after the year is part of the place name, e.g. 2021-MADISON EAST HIGH
+_PREFIX = re.compile(rf'^\s*(?P<year>(19|20)\d\d)(\s*-\s*(?P<county>{_COUNTY})(?=[\s-]|$))?[\s-]*',
+                     re.IGNORECASE)
+
+
+def parse_outbreak_name(outbreak_id:str) -> Tuple[str, str, str]:
+    """
+    :param outbreak_id: Outbreak#, e.g. 2021-DANE TYPICAL ELEMENTARY SCHOOL
+    :return: year, county and place name, e.g. ('2021', 'DANE', 'TYPICAL
+    ELEMENTARY SCHOOL'), year and county are '' if the name has no prefix
+    """
+    match = _PREFIX.match(outbreak_id)
+    if not match:
+        return '', '', outbreak_id.strip()
+    return match.group('year'), match.group('county') or '', outbreak_id[match.end():].strip()
+
+
+def normalize_key(text:str) -> str:
+    """
+    :return: text with apostrophes dropped, other punctuation and runs of
+    whitespace made single spaces, in title case like the names NER finds in
+    incident text, e.g. "MCDONALD'S - W. BELTLINE" -> 'Mcdonalds W Beltline'
+    """
+    text = text.replace("'", '')
+    return ' '.join(re.sub(r'[\W_]+', ' ', text).split()).title()
+
+
+def outbreak_match_keys(outbreak_id:str, outbreak_location:str) -> List[str]:
+    """
+    :param outbreak_id: Outbreak#
+    :param outbreak_location: OutbreakLocation
+    :return: normalized place name and location, without empty or repeated keys
+    """
+    keys = []
+    for key in (normalize_key(parse_outbreak_name(outbreak_id)[2]), normalize_key(outbreak_location or '')):
+        if key and key not in keys:
+            keys.append(key)
+    return keys
+
+
+def compare_outbreak_keys(bert_entities:Dict, rule_keys:Dict, match_ratio:int=70) -> Dict:
+    """
+    agreement between the entities NER finds in outbreak names and the rule
+    based keys
+    :param bert_entities: {Outbreak#: [entities]}
+    :param rule_keys: {Outbreak#: [keys]}
+    :param match_ratio: fuzz.partial_ratio at which two names match, as in
+    outbreak matching
+    :return: {Outbreak#: [entities, keys, same (case insensitive) names,
+    every key matched by an entity and every entity by a key]}
+    """
+    agreement = {}
+    for outbreak_id, keys in rule_keys.items():
+        entities = bert_entities.get(outbreak_id, [])
+        same = {x.casefold() for x in entities} == {x.casefold() for x in keys}
+        matched = (all(any(fuzz.partial_ratio(entity, key) >= match_ratio for entity in entities) for key in keys)
+                   and all(any(fuzz.partial_ratio(entity, key) >= match_ratio for key in keys) for entity in entities))
+        agreement[outbreak_id] = [entities, keys, same, matched]
+    return agreement
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar on-disk cache of the NLP_Patient extract.
+
+Selecting incidents for a report only needs four of the patient file's
+columns: IncidentID, County, EpisodeDate and ResolutionStatus. The cache
+parses those once per extract snapshot into NumPy arrays saved next to a
+small JSON manifest. Later runs memory-map the arrays and select incidents
+with vectorized filters instead of re-reading and re-splitting every row.
+
+The cache is rebuilt whenever the size or modification time of the patient
+file changes.
+"""
+from array import array
+from pathlib import Path
+from typing import List, Dict, Tuple
+import json
+import logging
+import os
+
+import numpy as np
+
+from date_periods import DatePeriod, date_key
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+
+# NLP_Patient column indexes
+INCIDENT_ID_COLUMN = 0
+COUNTY_COLUMN = 8
+EPISODE_DATE_COLUMN = 18
+RESOLUTION_STATUS_COLUMN = 33
+
+
+class PatientColumnCache:
+    """
+    memory-mapped IncidentID, County, EpisodeDate and ResolutionStatus columns
+    of a NLP_Patient file.
+
+    attributes:
+    patient_file: Path of the source NLP_Patient file
+    cache_path: directory holding the cached arrays and manifest.json
+    incident_ids: array of IncidentID strings, in file order
+    counties: array of int codes into county_labels
+    episode_dates: array of YYYYMMDD ints, date_periods.EMPTY_DATE or INVALID_DATE
+    statuses: array of int codes into status_labels (stripped values)
+    """
+    def __init__(self, patient_file: Path, cache_dir: Path):
+        self.patient_file = Path(patient_file)
+        self.cache_path = Path(cache_dir) / f'{self.patient_file.stem}_columns'
+        self.manifest_path = self.cache_path / 'manifest.json'
+
+    def _source_signature(self) -> Dict:
+        stat = self.patient_file.stat()
+        return {'version': CACHE_VERSION,
+                'source': str(self.patient_file.absolute()),
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns}
+
+    def is_valid(self) -> bool:
+        """
+        :return: True if the cache exists and was built from the current patient file
+        """
+        if not self.manifest_path.exists():
+            return False
+        with self.manifest_path.open('r') as f:
+            manifest = json.load(f)
+        return manifest.get('signature') == self._source_signature()
+
+    def build(self):
+        """
+        read the patient file once and write its selection columns to the cache
+        """
+        logger.info(f'building patient column cache for {self.patient_file} in {self.cache_path}')
+        signature = self._source_signature()
+        incident_ids = []
+        counties = array('i')
+        episode_dates = array('i')
+        statuses = array('i')
+        county_codes = {}
+        status_codes = {}
+        date_keys = {}
+        with self.patient_file.open('r', encoding='ISO-8859-1') as f:
+            next(f, None)  # skip header row
+            for line in f:
+                # only split as far as the last column cached
+                ls = line.split("|", RESOLUTION_STATUS_COLUMN + 1)
+                if len(ls) <= RESOLUTION_STATUS_COLUMN:
+                    ls.extend([''] * (RESOLUTION_STATUS_COLUMN + 1 - len(ls)))
+                incident_ids.append(ls[INCIDENT_ID_COLUMN])
+                counties.append(county_codes.setdefault(ls[COUNTY_COLUMN], len(county_codes)))
+                status = ls[RESOLUTION_STATUS_COLUMN].strip()
+                statuses.append(status_codes.setdefault(status, len(status_codes)))
+                episode_date = ls[EPISODE_DATE_COLUMN]
+                if episode_date not in date_keys:
+                    date_keys[episode_date] = date_key(episode_date)
+                episode_dates.append(date_keys[episode_date])
+
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+        # drop the manifest first so a half written cache is never used
+        if self.manifest_path.exists():
+            self.manifest_path.unlink()
+        columns = {
+            'incident_ids': np.array(incident_ids, dtype=str),
+            'counties': np.frombuffer(counties, dtype=np.int32),
+            'episode_dates': np.frombuffer(episode_dates, dtype=np.int32),
+            'statuses': np.frombuffer(statuses, dtype=np.int32),
+            }
+        for name, values in columns.items():
+            np.save(self.cache_path / f'{name}.npy', values)
+        manifest = {'signature': signature,
+                    'rows': len(incident_ids),
+                    'county_labels': list(county_codes),
+                    'status_labels': list(status_codes)}
+        tmp_path = self.manifest_path.with_suffix('.tmp')
+        with tmp_path.open('w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+        logger.info(f'cached {len(incident_ids)} patient rows')
+
+    def load(self) -> 'PatientColumnCache':
+        """
+        memory-map the cached columns, building the cache first if it is
+        missing or stale.
+        :return: self
+        """
+        if not self.is_valid():
+            self.build()
+        with self.manifest_path.open('r') as f:
+            manifest = json.load(f)
+        self.county_labels = manifest['county_labels']
+        self.status_labels = manifest['status_labels']
+        self.incident_ids = np.load(self.cache_path / 'incident_ids.npy', mmap_mode='r')
+        self.counties = np.load(self.cache_path / 'counties.npy', mmap_mode='r')
+        self.episode_dates = np.load(self.cache_path / 'episode_dates.npy', mmap_mode='r')
+        self.statuses = np.load(self.cache_path / 'statuses.npy', mmap_mode='r')
+        return self
+
+    def _label_mask(self, codes: np.ndarray, labels: List, wanted: List) -> np.ndarray:
+        wanted_codes = [i for i, label in enumerate(labels) if label in wanted]
+        return np.isin(codes, wanted_codes)
+
+    def date_mask(self, date_period: DatePeriod) -> np.ndarray:
+        """
+        :param date_period: reporting period
+        :return: boolean array, True for rows with an EpisodeDate in the period.
+        With 'all' every row with a non empty EpisodeDate is selected.
+        """
+        return date_period.mask(self.episode_dates)
+
+    def select(self, date_mask: np.ndarray, search_county: str,
+               usable_resolution_statuses: List) -> Tuple[List, int]:
+        """
+        :param date_mask: boolean array of rows in the reporting period
+        :param search_county: county to search in for incidents
+        :param usable_resolution_statuses: ResolutionStatus values to keep
+        :return: (IncidentIDs in the period and county with a usable status in
+        file order, count of incidents in the period and county with any status)
+        """
+        in_county = date_mask & self._label_mask(self.counties, self.county_labels, [search_county])
+        usable = in_county & self._label_mask(self.statuses, self.status_labels, usable_resolution_statuses)
+        return self.incident_ids[usable].tolist(), int(in_county.sum())
@@ -16,7 +16,8 @@ setup(
         'tqdm',
         'torch',
         'transformers',
-        'fuzzywuzzy'
+        'fuzzywuzzy',
+        'numpy'
 
     ]
 )
\ No newline at end of file
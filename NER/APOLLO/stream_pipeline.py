@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming execution of pipeline stages over bounded queues.
+
+run_stages runs a source of work items, e.g. blocks of incidents read from
+the WEDSS extracts, and a chain of stage functions, e.g. text cleaning then
+NER, each in its own thread with a bounded queue in front of every stage.
+A stage that falls behind fills its queue and blocks the stages feeding it,
+so memory stays bounded, and while one stage waits on the disk another runs
+the model: end to end time approaches that of the slowest stage rather than
+the sum of all of them.
+
+StageMonitor keeps per stage item counts, busy time and the depth of the
+queue in front of each stage, the queue that stays full points at the
+bottleneck.
+"""
+from typing import List, Dict, Callable, Iterable, Iterator, Tuple
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_END = object()  # put on a queue after the last item
+
+
+class StageMonitor:
+    """
+    thread safe per stage throughput and queue depth counters
+
+    attributes:
+    stages: {stage name: {'items', 'busy seconds', 'queue samples',
+    'queue depth total', 'max queue depth'}} in pipeline order
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.start = time.perf_counter()
+
+    def add_stage(self, name:str):
+        with self._lock:
+            self.stages[name] = {'items': 0, 'busy seconds': 0.0, 'queue samples': 0,
+                                 'queue depth total': 0, 'max queue depth': 0}
+
+    def record(self, name:str, items:int, seconds:float, queue_depth:int=None):
+        """
+        :param name: stage name
+        :param items: number of items, e.g. incidents, the stage processed
+        :param seconds: time the stage spent on them
+        :param queue_depth: depth of the stage's input queue when it took them
+        """
+        with self._lock:
+            stage = self.stages[name]
+            stage['items'] += items
+            stage['busy seconds'] += seconds
+            if queue_depth is not None:
+                stage['queue samples'] += 1
+                stage['queue depth total'] += queue_depth
+                stage['max queue depth'] = max(stage['max queue depth'], queue_depth)
+
+    def get_stats(self) -> Dict:
+        """
+        :return: {stage name: [items, busy seconds, items per busy second,
+        mean input queue depth, max input queue depth]}
+        """
+        with self._lock:
+            stats = {}
+            for name, stage in self.stages.items():
+                busy = stage['busy seconds']
+                samples = stage['queue samples']
+                stats[name] = [stage['items'],
+                               round(busy, 3),
+                               round(stage['items']/busy, 2) if busy else 0,
+                               round(stage['queue depth total']/samples, 2) if samples else 0,
+                               stage['max queue depth']]
+            return stats
+
+    def summary(self) -> str:
+        return ', '.join(f'{name}: {items} items, {rate}/s busy, queue {depth}'
+                         for name, (items, _, rate, depth, _) in self.get_stats().items())
+
+
+def _put(q:queue.Queue, item, stop:threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q:queue.Queue, stop:threading.Event):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _END
+
+
+def run_stages(source:Iterable, stages:List[Tuple[str, Callable]], source_name:str='read',
+               sink_name:str='aggregate', size:Callable=len, queue_size:int=4,
+               monitor:StageMonitor=None, log_every:float=30) -> Iterator:
+    """
+    run source and stages in one thread each, connected by bounded queues.
+    Every stage has a single thread, so items come out in source order.
+    :param source: iterable of work items, iterated in its own thread
+    :param stages: list of (name, function) taking an item and returning the
+    item for the next stage
+    :param source_name: name the source is monitored by
+    :param sink_name: name the caller's processing of the output is monitored by
+    :param size: item -> number of items counted in it, e.g. incidents in a block
+    :param queue_size: most items waiting in front of a stage
+    :param monitor: StageMonitor to record in, default a new one
+    :param log_every: seconds between progress log messages
+    :return: iterator of the last stage's items. An exception in any stage
+    stops every stage and is raised here.
+    """
+    monitor = monitor or StageMonitor()
+    monitor.add_stage(source_name)
+    for name, _ in stages:
+        monitor.add_stage(name)
+    monitor.add_stage(sink_name)
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    stop = threading.Event()
+    errors = []
+
+    def feed():
+        items = iter(source)
+        while True:
+            start = time.perf_counter()
+            item = next(items, _END)
+            if item is _END:
+                break
+            monitor.record(source_name, size(item), time.perf_counter() - start)
+            if not _put(queues[0], item, stop):
+                return
+        _put(queues[0], _END, stop)
+
+    def work(name, function, input_queue, output_queue):
+        while True:
+            depth = input_queue.qsize()
+            item = _get(input_queue, stop)
+            if item is _END:
+                break
+            start = time.perf_counter()
+            item = function(item)
+            monitor.record(name, size(item), time.perf_counter() - start, depth)
+            if not _put(output_queue, item, stop):
+                return
+        _put(output_queue, _END, stop)
+
+    def guarded(target, *args):
+        try:
+            target(*args)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [threading.Thread(target=guarded, args=(feed,), name=source_name, daemon=True)]
+    for k, (name, function) in enumerate(stages):
+        threads.append(threading.Thread(target=guarded, args=(work, name, function, queues[k], queues[k+1]),
+                                        name=name, daemon=True))
+    for thread in threads:
+        thread.start()
+
+    last_log = time.perf_counter()
+    try:
+        while True:
+            depth = queues[-1].qsize()
+            item = _get(queues[-1], stop)
+            if item is _END:
+                break
+            start = time.perf_counter()
+            yield item
+            monitor.record(sink_name, size(item), time.perf_counter() - start, depth)
+            if time.perf_counter() - last_log >= log_every:
+                logger.info(monitor.summary())
+                last_log = time.perf_counter()
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    logger.info(f'streamed in {time.perf_counter() - monitor.start:.1f}s: {monitor.summary()}')
@@ -0,0 +1,142 @@
+"""
+Checks of NERPipeline's windowing, BIO decoding and segment dedup that need
+no model: a stub tokenizer stands in for bert-base-NER's.
+"""
+from collections import Counter
+import random
+
+import numpy as np
+import pytest
+
+from NERPipeline import NERPipeline
+
+CLS, SEP = 101, 102
+# bert-base-NER's labels in label index order
+LABELS = ['O', 'B-MISC', 'I-MISC', 'B-PER', 'I-PER', 'B-ORG', 'I-ORG', 'B-LOC', 'I-LOC']
+
+
+class StubTokenizer:
+    cls_token_id = CLS
+    sep_token_id = SEP
+    sep_token = '[SEP]'
+
+    def __call__(self, texts, add_special_tokens=False):
+        return {'input_ids': [[1]*len(text.split()) for text in texts]}
+
+
+class StubPipeline(NERPipeline):
+    tokenizer = StubTokenizer()
+
+    def __init__(self, max_tokens=16, stride=4):
+        self._max_tokens = max_tokens
+        self.stride = stride
+        self.dedup_stats = {'segments': 0, 'duplicate segments': 0, 'duplicate tokens': 0}
+        self._set_labels(LABELS)
+
+    @property
+    def max_tokens(self):
+        return self._max_tokens
+
+
+def random_text(n, seed):
+    """
+    :return: token ids and word ids of n tokens, words of 1 to 3 tokens and
+    a [SEP] every now and then
+    """
+    rng = random.Random(seed)
+    input_ids, word_ids = [], []
+    word = 0
+    while len(input_ids) < n:
+        if rng.random() < 0.1:
+            input_ids.append(SEP)
+            word_ids.append(None)
+            continue
+        for _ in range(rng.randint(1, 3)):
+            input_ids.append(rng.randint(1000, 2000))
+            word_ids.append(word)
+        word += 1
+    return input_ids[:n], word_ids[:n]
+
+
+@pytest.mark.parametrize('max_tokens,stride', [(16, 0), (16, 4), (16, 7), (32, 10), (510, 64)])
+@pytest.mark.parametrize('n', [0, 1, 15, 16, 17, 100, 2000])
+def test_token_windows_own_every_token_once(max_tokens, stride, n):
+    nlp = StubPipeline(max_tokens, stride)
+    input_ids, word_ids = random_text(n, seed=n*max_tokens + stride)
+    windows = nlp._token_windows(input_ids, word_ids)
+    owned = []
+    for start, end, owned_start, owned_end in windows:
+        assert 0 < end - start <= max_tokens
+        assert start <= owned_start <= owned_end <= end
+        owned.extend(range(owned_start, owned_end))
+    assert owned == list(range(n))
+
+
+def test_token_windows_overlap_by_stride():
+    nlp = StubPipeline(16, 4)
+    input_ids, word_ids = list(range(1000, 1100)), list(range(100))
+    windows = nlp._token_windows(input_ids, word_ids)
+    assert len(windows) > 1
+    for (_, end, _, _), (next_start, _, _, _) in zip(windows, windows[1:]):
+        assert end - next_start == 4
+
+
+def decode(nlp, tokens, labels, scores):
+    """
+    :param tokens: (token id, word id, start, end) per token
+    """
+    text = 'John Smith visited Madison Clinic[SEP]Badger Alice Bob'
+    input_ids = [t[0] for t in tokens]
+    word_ids = [t[1] for t in tokens]
+    offsets = [(t[2], t[3]) for t in tokens]
+    labels = np.array([LABELS.index(label) for label in labels])
+    return nlp.decode_entities(text, input_ids, word_ids, offsets, labels, np.array(scores))
+
+
+def test_decode_entities_slices_source_offsets():
+    nlp = StubPipeline()
+    tokens = [(1, 0, 0, 4), (2, 1, 5, 10), (3, 2, 11, 18), (4, 3, 19, 26),
+              (5, 4, 27, 31), (6, 4, 31, 33), (SEP, None, 33, 38),
+              (7, 5, 38, 44), (8, 6, 45, 50), (9, 7, 51, 54)]
+    # ##ic takes its word's first token label, the [SEP] is never in an
+    # entity, and a B- label starts a new entity of the same type
+    labels = ['B-PER', 'I-PER', 'O', 'B-LOC', 'I-LOC', 'O', 'I-LOC', 'B-ORG', 'B-PER', 'B-PER']
+    scores = [0.9, 0.7, 0.5, 0.8, 0.6, 0.4, 0.3, 0.2, 0.1, 0.3]
+    entities, types, mean_scores, offsets = decode(nlp, tokens, labels, scores)
+    assert entities == ['John Smith', 'Madison Clinic', 'Badger', 'Alice', 'Bob']
+    assert types == ['Person', 'Location', 'Organization', 'Person', 'Person']
+    assert offsets == [0, 19, 38, 45, 51]
+    assert mean_scores == pytest.approx([0.8, 0.6, 0.2, 0.1, 0.3])
+
+
+def test_decode_entities_without_entities():
+    nlp = StubPipeline()
+    assert decode(nlp, [], [], []) == ([], [], [], [])
+    assert decode(nlp, [(1, 0, 0, 4)], ['O'], [0.9]) == ([], [], [], [])
+
+
+def test_dedup_then_restore_keeps_multiplicity():
+    nlp = StubPipeline()
+    text = '|Madison Clinic|Seen at Madison| madison  clinic|Madison Clinic|Other|MADISON CLINIC'
+    deduped, back_references = nlp._dedup_segments(text, '[SEP]')
+    assert deduped == '[SEP]Madison Clinic[SEP]Seen at Madison[SEP]Other'
+    assert [(deduped[start:end], n) for start, end, n in back_references] == [('Madison Clinic', 4)]
+    assert nlp.dedup_stats['duplicate segments'] == 3
+
+    # entities as NER would find them in the deduplicated text
+    found = ['Madison Clinic', 'Madison', 'Other']
+    offsets = [deduped.index('Madison Clinic'), deduped.index('Madison', deduped.index('Seen')),
+               deduped.index('Other')]
+    entities, types, scores = nlp._restore_duplicates(found, ['Location']*3, [0.9, 0.8, 0.7],
+                                                      offsets, back_references)
+    # as often as in the full text: Madison in a unique segment is not
+    # repeated for the repeated Madison Clinic segment containing its text
+    assert Counter(entities) == Counter({'Madison Clinic': 4, 'Madison': 1, 'Other': 1})
+    assert len(types) == len(scores) == len(entities)
+
+
+def test_dedup_without_duplicates_changes_nothing():
+    nlp = StubPipeline()
+    deduped, back_references = nlp._dedup_segments('a|b|c')
+    assert (deduped, back_references) == ('a|b|c', [])
+    assert nlp._restore_duplicates(['a'], ['Person'], [0.5], [0], back_references) == (['a'], ['Person'], [0.5])
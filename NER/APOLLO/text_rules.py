@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Configurable text cleaning rules applied to WEDSS text before NER.
+
+Rules are read from a CSV file with the columns name, action, pattern and
+replacement, and applied in file order. Actions are:
+    skip: drop the incident if pattern matches at the start of its raw text
+    delete: remove every match of pattern
+    replace: replace every match of pattern with replacement (re.sub syntax)
+
+Patterns are compiled once and each rule is applied with a single subn()
+call, which also gives its hit count. Merging the delete rules into one
+alternation was measured slower: Python's re engine tries every alternative
+at every position and loses the literal prefix search each rule gets on its
+own, so one sweep per rule is the cheaper linear pass.
+"""
+from pathlib import Path
+from typing import List, Dict, Tuple
+import csv
+import hashlib
+import re
+import time
+
+SKIP = 'skip'
+DELETE = 'delete'
+REPLACE = 'replace'
+ACTIONS = (SKIP, DELETE, REPLACE)
+
+# the rules wedss_text_filter has always applied, the default unless a rules
+# file is given: copy it as a starting point for local additions
+DEFAULT_RULES_FILE = Path(__file__).resolve().parent.parent / 'supporting_data' / 'text_cleaning_rules.csv'
+
+
+class InvalidTextRuleError(Exception):
+    pass
+
+
+class TextCleaner:
+    """
+    compiled text cleaning rules with per rule hit counts and timings
+
+    attributes:
+    rules: list of (name, action, pattern, replacement) in application order
+    skip_rules: list of (name, compiled pattern)
+    substitutions: list of (name, compiled pattern, replacement)
+    hits: {rule name: number of matches, or of incidents skipped}
+    seconds: {rule name: time spent applying the rule}
+    """
+    def __init__(self, rules:List[Tuple[str, str, str, str]]):
+        self.rules = list(rules)
+        self.skip_rules = []
+        self.substitutions = []
+        names = set()
+        for name, action, pattern, replacement in self.rules:
+            if action not in ACTIONS:
+                raise InvalidTextRuleError(f'rule {name}: action must be one of {ACTIONS}, not {action!r}')
+            if not name or name in names:
+                raise InvalidTextRuleError(f'rule name {name!r} must be unique and not empty')
+            names.add(name)
+            try:
+                compiled = re.compile(pattern)
+            except re.error as e:
+                raise InvalidTextRuleError(f'rule {name}: invalid pattern {pattern!r}: {e}')
+            if action == SKIP:
+                self.skip_rules.append((name, compiled))
+            elif action == DELETE:
+                self.substitutions.append((name, compiled, ''))
+            else:
+                self.substitutions.append((name, compiled, replacement))
+        self.reset_stats()
+
+    @classmethod
+    def from_file(cls, rules_file:Path=DEFAULT_RULES_FILE) -> 'TextCleaner':
+        """
+        :param rules_file: csv file with a header row and the columns name,
+        action, pattern, replacement, default the built in rules
+        :return: TextCleaner applying the file's rules in file order
+        """
+        rules = []
+        with Path(rules_file).open('r', newline='') as f:
+            for row in csv.DictReader(f):
+                if not row.get('name'):
+                    continue
+                rules.append((row['name'].strip(),
+                              row['action'].strip().lower(),
+                              row['pattern'],
+                              row.get('replacement') or ''))
+        return cls(rules)
+
+    def signature(self) -> str:
+        """
+        :return: hash identifying the rules, changes whenever a rule does
+        """
+        return hashlib.sha1(repr(self.rules).encode('utf-8')).hexdigest()
+
+    def reset_stats(self):
+        self.hits = {name: 0 for name, _, _, _ in self.rules}
+        self.seconds = {name: 0.0 for name, _, _, _ in self.rules}
+
+    def clean(self, text:str) -> str:
+        """
+        :param text: raw WEDSS text for an incident
+        :return: cleaned text, or None if a skip rule matched
+        """
+        for name, pattern in self.skip_rules:
+            start = time.perf_counter()
+            matched = pattern.match(text)
+            self.seconds[name] += time.perf_counter() - start
+            if matched:
+                self.hits[name] += 1
+                return None
+
+        for name, pattern, replacement in self.substitutions:
+            start = time.perf_counter()
+            text, count = pattern.subn(replacement, text)
+            self.seconds[name] += time.perf_counter() - start
+            self.hits[name] += count
+        return text
+
+    def get_rule_stats(self) -> Dict:
+        """
+        :return: {rule name: [action, hits, seconds]}
+        """
+        return {name: [action, self.hits[name], round(self.seconds[name], 6)]
+                for name, action, _, _ in self.rules}
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming statistics of the BERT tokens run through NER.
+
+Instead of keeping every document's token ids, TokenStatistics keeps running
+totals, a bitmap of the token ids seen, sized to the tokenizer vocabulary, and
+a count of documents per token length. Document lengths are integers with far
+fewer distinct values than there are documents, so the length counts give
+exact medians and quartiles in memory that does not grow with the corpus.
+"""
+from collections import Counter
+from typing import List, Dict
+import statistics
+
+import numpy as np
+
+
+class TokenStatistics:
+    """
+    attributes:
+    doc_count: number of documents added
+    token_count: number of tokens in all documents
+    seen: boolean array, True for every token id seen
+    length_counts: Counter {document length in tokens: number of documents}
+    """
+    def __init__(self, vocab_size:int):
+        self.doc_count = 0
+        self.token_count = 0
+        self.seen = np.zeros(vocab_size, dtype=bool)
+        self.length_counts = Counter()
+
+    def add(self, tokens:List):
+        """
+        :param tokens: token ids of one document
+        """
+        self.doc_count += 1
+        self.token_count += len(tokens)
+        self.length_counts[len(tokens)] += 1
+        if tokens:
+            ids = np.asarray(tokens, dtype=np.int64)
+            if ids.max() >= len(self.seen):
+                self.seen = np.concatenate([self.seen, np.zeros(int(ids.max()) + 1 - len(self.seen), dtype=bool)])
+            self.seen[ids] = True
+
+    def merge(self, other:'TokenStatistics'):
+        """
+        add the documents counted by other, e.g. in a worker process
+        """
+        self.doc_count += other.doc_count
+        self.token_count += other.token_count
+        self.length_counts.update(other.length_counts)
+        if len(other.seen) > len(self.seen):
+            self.seen = np.concatenate([self.seen, np.zeros(len(other.seen) - len(self.seen), dtype=bool)])
+        self.seen[:len(other.seen)] |= other.seen
+
+    @staticmethod
+    def _median(length_counts:List) -> float:
+        """
+        statistics.median of the lengths length_counts describes
+        :param length_counts: sorted [(length, number of documents)]
+        """
+        n = sum(count for _, count in length_counts)
+        if n == 0:
+            raise statistics.StatisticsError('no median for empty data')
+
+        def nth(k):
+            for length, count in length_counts:
+                if k < count:
+                    return length
+                k -= count
+
+        if n % 2 == 1:
+            return nth(n//2)
+        return (nth(n//2 - 1) + nth(n//2))/2
+
+    def get_stats(self) -> Dict:
+        """
+        :return: the statistics NERPipeline.get_token_stats has always reported
+        """
+        token_stats = {}
+        token_stats['total_doc_count'] = self.doc_count
+        token_stats['total tokens'] = self.token_count
+        token_stats['total unique tokens'] = int(self.seen.sum())
+        length_counts = sorted(self.length_counts.items())
+        median = self._median(length_counts)
+        LQ = self._median([(x, n) for x, n in length_counts if x <= median])
+        UQ = self._median([(x, n) for x, n in length_counts if x >= median])
+        token_stats['token count median'] = median
+        token_stats['token count lower quartile'] = LQ
+        token_stats['token count upper quartile'] = UQ
+        token_stats['token count IQR'] = UQ-LQ
+        return token_stats
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent IncidentID index over all WEDSS NLP_*.txt extract files.
+
+The index is a SQLite database mapping every IncidentID to the byte offset
+and length of each of its rows in each extract file. It is built with one
+scan of the extracts per snapshot, after which the rows for any set of
+incidents are read with a seek and a read per row instead of a full scan.
+
+The index is rebuilt whenever the set of extract files, or the size or
+modification time of any of them, changes.
+"""
+from pathlib import Path
+from typing import List, Dict, Iterator, Tuple
+import logging
+import os
+import sqlite3
+
+from wedss_reader import iter_lines_with_offsets, decode_line, WEDSS_ENCODING
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+_INSERT_BATCH = 50000
+
+
+class WedssIncidentIndex:
+    """
+    IncidentID -> [(file, byte offset, length)] index of WEDSS extract rows
+
+    attributes:
+    file_paths: list of indexed WEDSS files
+    index_path: SQLite database file
+    """
+    def __init__(self, file_paths: List[Path], index_path: Path):
+        self.file_paths = [Path(x) for x in file_paths]
+        self.index_path = Path(index_path)
+        self._connection = None
+
+    def _file_signatures(self) -> Dict[str, Tuple[int, int]]:
+        signatures = {}
+        for path in self.file_paths:
+            stat = path.stat()
+            signatures[str(path.absolute())] = (stat.st_size, stat.st_mtime_ns)
+        return signatures
+
+    def is_valid(self) -> bool:
+        """
+        :return: True if the index exists and was built from the current extract files
+        """
+        if not self.index_path.exists():
+            return False
+        connection = sqlite3.connect(str(self.index_path))
+        try:
+            version = connection.execute("SELECT value FROM meta WHERE key='version'").fetchone()
+            indexed = {path: (size, mtime_ns) for path, size, mtime_ns
+                       in connection.execute("SELECT path, size, mtime_ns FROM files")}
+        except sqlite3.DatabaseError:
+            return False
+        finally:
+            connection.close()
+        return version == (str(INDEX_VERSION),) and indexed == self._file_signatures()
+
+    def build(self):
+        """
+        scan every extract file once and record the offset of every data row
+        """
+        logger.info(f'building WEDSS incident index {self.index_path} over {len(self.file_paths)} files')
+        self.close()
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_suffix('.tmp')
+        if tmp_path.exists():
+            tmp_path.unlink()
+        connection = sqlite3.connect(str(tmp_path))
+        connection.executescript("""
+            PRAGMA journal_mode=OFF;
+            PRAGMA synchronous=OFF;
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE files (file_id INTEGER PRIMARY KEY, path TEXT UNIQUE,
+                                size INTEGER, mtime_ns INTEGER,
+                                header_offset INTEGER, header_length INTEGER);
+            CREATE TABLE rows (incident_id TEXT, file_id INTEGER,
+                               offset INTEGER, length INTEGER);
+            """)
+        connection.execute("INSERT INTO meta VALUES ('version', ?)", (str(INDEX_VERSION),))
+        row_count = 0
+        for file_id, (path, (size, mtime_ns)) in enumerate(self._file_signatures().items()):
+            header = (0, 0)
+            batch = []
+            with open(path, 'rb') as f:
+                for counter, (offset, raw) in enumerate(iter_lines_with_offsets(f)):
+                    if counter == 0:
+                        header = (offset, len(raw))
+                        continue
+                    end = raw.find(b'|')
+                    if end < 0:
+                        continue  # not a data row, can't belong to any incident
+                    batch.append((raw[:end].decode(WEDSS_ENCODING), file_id, offset, len(raw)))
+                    if len(batch) >= _INSERT_BATCH:
+                        connection.executemany("INSERT INTO rows VALUES (?,?,?,?)", batch)
+                        row_count += len(batch)
+                        batch = []
+            connection.executemany("INSERT INTO rows VALUES (?,?,?,?)", batch)
+            row_count += len(batch)
+            connection.execute("INSERT INTO files VALUES (?,?,?,?,?,?)",
+                               (file_id, path, size, mtime_ns) + header)
+        connection.execute("CREATE INDEX rows_incident_id ON rows (incident_id)")
+        connection.commit()
+        connection.close()
+        os.replace(tmp_path, self.index_path)
+        logger.info(f'indexed {row_count} WEDSS rows')
+
+    def load(self) -> 'WedssIncidentIndex':
+        """
+        open the index, building it first if it is missing or stale.
+        :return: self
+        """
+        if not self.is_valid():
+            self.build()
+        self._connection = sqlite3.connect(str(self.index_path))
+        self._file_ids = {path: file_id for file_id, path
+                          in self._connection.execute("SELECT file_id, path FROM files")}
+        return self
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __getstate__(self):
+        # sqlite connections can't be sent to pool workers, they reconnect
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if hasattr(self, '_file_ids'):
+            self._connection = sqlite3.connect(str(self.index_path))
+
+    def _file_id(self, file_path: Path) -> int:
+        return self._file_ids[str(Path(file_path).absolute())]
+
+    def locate(self, file_path: Path, ids) -> List[Tuple[str, int, int]]:
+        """
+        :param file_path: an indexed WEDSS file
+        :param ids: iterable of incidentIDs
+        :return: [(incidentID, byte offset, length)] of every row for ids in
+        file_path, in file order
+        """
+        connection = self._connection
+        connection.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (incident_id TEXT PRIMARY KEY)")
+        connection.execute("DELETE FROM wanted")
+        connection.executemany("INSERT OR IGNORE INTO wanted VALUES (?)", ((x,) for x in ids))
+        return connection.execute(
+            "SELECT rows.incident_id, rows.offset, rows.length FROM rows "
+            "JOIN wanted ON rows.incident_id = wanted.incident_id "
+            "WHERE rows.file_id = ? ORDER BY rows.offset",
+            (self._file_id(file_path),)).fetchall()
+
+    def header(self, file_path: Path) -> str:
+        """
+        :param file_path: an indexed WEDSS file
+        :return: the file's header row
+        """
+        offset, length = self._connection.execute(
+            "SELECT header_offset, header_length FROM files WHERE file_id = ?",
+            (self._file_id(file_path),)).fetchone()
+        with open(file_path, 'rb') as f:
+            f.seek(offset)
+            return decode_line(f.read(length))
+
+    def read_lines(self, file_path: Path, ids) -> Iterator[str]:
+        """
+        read only the rows for ids from file_path
+        :param file_path: an indexed WEDSS file
+        :param ids: iterable of incidentIDs
+        :return: iterator of rows, exactly as reading the file in text mode
+        would return them, in file order
+        """
+        locations = self.locate(file_path, ids)
+        with open(file_path, 'rb') as f:
+            for incident_id, offset, length in locations:
+                f.seek(offset)
+                yield decode_line(f.read(length))
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming readers for WEDSS NLP_*.txt extract files.
+
+Extract files can be several GB each, so nothing here holds a whole file in
+memory: files are read line by line and only the text needed for the
+incidents being examined is kept.
+"""
+from pathlib import Path
+from typing import List, Dict, Iterable, Iterator, Tuple
+import re
+
+WEDSS_ENCODING = 'ISO-8859-1'
+
+# a line as python's universal newlines text mode sees it: ending in \r\n, \r or \n
+_LINE = re.compile(rb'[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+')
+
+
+def iter_lines_with_offsets(f) -> Iterator[Tuple[int, bytes]]:
+    """
+    iterate over a file opened in binary mode, splitting lines the same way
+    as a file opened in text mode does.
+    :param f: binary file object positioned at the start of the file
+    :return: iterator of (byte offset, raw line bytes including the line ending)
+    """
+    offset = 0
+    for raw in f:
+        if b'\r' not in raw:
+            yield offset, raw
+        else:
+            # lone \r's end lines in text mode too
+            for m in _LINE.finditer(raw):
+                yield offset + m.start(), m.group()
+        offset += len(raw)
+
+
+def decode_line(raw: bytes) -> str:
+    """
+    decode a raw line from iter_lines_with_offsets to exactly the string text
+    mode would have returned for it, line ending translated to \\n.
+    """
+    line = raw.decode(WEDSS_ENCODING)
+    if line.endswith('\r\n'):
+        return line[:-2] + '\n'
+    if line.endswith('\r'):
+        return line[:-1] + '\n'
+    return line
+
+
+def get_text_columns(header: List, nlp_fields: Dict) -> List:
+    """
+    determine which columns in a WEDSS file are relevant: those whose header
+    value is in the NLPFields.csv file, or contains "_Sec".
+    :param header: header row of a WEDSS file split on '|'
+    :param nlp_fields: {'header name':1}
+    :return: list of column indexes, in file order
+    """
+    return [i for i, name in enumerate(header) if name in nlp_fields or "_Sec" in name]
+
+
+def fragments_from_rows(header_line: str, lines: Iterable[str], nlp_fields: Dict,
+                        ids: Dict) -> Dict[str, List[str]]:
+    """
+    collect the text of every relevant column for each incident in ids
+    :param header_line: header row of the WEDSS file the lines come from
+    :param lines: data rows of that file
+    :param nlp_fields: {'header name':1}
+    :param ids: {incidentID:1} incidents to collect text for
+    :return: {incidentID: ['|value', '|value', ...]} in row order, one
+    fragment per relevant column per row
+    """
+    columns = get_text_columns(header_line.split("|"), nlp_fields)
+    fragments = {}
+    for line in lines:
+        # most rows belong to other incidents: check the leading IncidentID
+        # and only split the rows that are kept
+        incident_id = line.partition("|")[0]
+        if incident_id in ids:
+            ls = line.split("|")
+            buffer = fragments.get(incident_id)
+            if buffer is None:
+                buffer = fragments[incident_id] = []
+            buffer.extend('|' + ls[key] for key in columns if key < len(ls))
+    return fragments
+
+
+def collect_text_fragments(file_path: Path, nlp_fields: Dict, ids: Dict,
+                           incident_index=None) -> Dict[str, List[str]]:
+    """
+    collect the text of every relevant column for each incident in ids from a
+    single WEDSS file, streaming the whole file or, given an incident index,
+    reading only the rows for ids. Module level so it can be run in a process
+    pool, one file per task.
+    :param file_path: WEDSS NLP_*.txt file
+    :param nlp_fields: {'header name':1}
+    :param ids: {incidentID:1} incidents to collect text for
+    :param incident_index: optional loaded wedss_index.WedssIncidentIndex
+    :return: {incidentID: ['|value', '|value', ...]} in file order, one
+    fragment per relevant column per row
+    """
+    if incident_index is not None:
+        return fragments_from_rows(incident_index.header(file_path),
+                                   incident_index.read_lines(file_path, ids),
+                                   nlp_fields,
+                                   ids)
+    with Path(file_path).open('r', encoding=WEDSS_ENCODING) as f:
+        # first line of a file is the header row
+        header_line = next(f, '')
+        return fragments_from_rows(header_line, f, nlp_fields, ids)
@@ -5,7 +5,7 @@ from dateutil.relativedelta import relativedelta
 
 # run on linsilogpu001.ssc.wisc.edu
 
-def run_APOLLO(report_date, period, input_path, output_path, nlp_fields, stop_entities, prefix, final_report_only):
+def run_APOLLO(report_date, period, input_path, output_path, nlp_fields, stop_entities, prefix, final_report_only, cache_dir=None, incremental_store=None):
     """
     Run the APOLLO pipeline
     """
@@ -15,10 +15,27 @@ def run_APOLLO(report_date, period, input_path, output_path, nlp_fields, stop_en
                               nlp_fields_file = nlp_fields,
                               stop_entities_file = stop_entities,
                               file_prefix=prefix,
-                              final_report_only=final_report_only)
+                              final_report_only=final_report_only,
+                              cache_dir=cache_dir,
+                              incremental_store=incremental_store)
     
     detector.run_pipeline(report_date, period)
 
+def run_APOLLO_multi(periods, prefixes, input_path, output_path, nlp_fields, stop_entities, final_report_only, cache_dir=None, incremental_store=None):
+    """
+    Run the APOLLO pipeline for several periods, scanning WEDSS and running NER once
+    """
+    
+    detector = ApolloDetector(input_path, 
+                              output_path = output_path, 
+                              nlp_fields_file = nlp_fields,
+                              stop_entities_file = stop_entities,
+                              final_report_only=final_report_only,
+                              cache_dir=cache_dir,
+                              incremental_store=incremental_store)
+    
+    detector.run_pipeline_multi(periods, prefixes)
+
 if __name__ == '__main__':
     #
     # Set up to run APOLLO for each month separately for YTD.
@@ -29,22 +46,20 @@ if __name__ == '__main__':
     nlp_fields='supporting_data/nlp_fields.csv'
     stop_entities='supporting_data/all_stop_entities_list_min_df_0_pc_2021-04-22_00_31_plus_UHS_MAXIM_names.csv'
     final_report_only = False
+    # patient file columns are cached here once and reused by later runs
+    cache_dir='output_dir/cache'
     
     start_date = date.fromisoformat('2021-05-01')
     date_range = []
     for i in range(12):
         date_range.append((start_date-relativedelta(months=i)).strftime("%Y-%m-%d"))
         
-    for report_date, prefix in {k: k[:7] for k in date_range}.items(): 
-        print('')
-        print(f'NOW RUNNING {report_date}')
-        print('')
-        run_APOLLO(report_date=report_date, 
-                   period=period, 
-                   input_path=input_path, 
-                   output_path=output_path, 
-                   nlp_fields=nlp_fields, 
-                   stop_entities=stop_entities, 
-                   prefix=prefix,
-                   final_report_only=final_report_only)
-   
\ No newline at end of file
+    # one WEDSS scan and NER pass for the whole year, one final report per month
+    run_APOLLO_multi(periods=[(report_date, period) for report_date in date_range], 
+                     prefixes=[report_date[:7] for report_date in date_range], 
+                     input_path=input_path, 
+                     output_path=output_path, 
+                     nlp_fields=nlp_fields, 
+                     stop_entities=stop_entities, 
+                     final_report_only=final_report_only,
+                     cache_dir=cache_dir)